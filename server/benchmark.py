@@ -0,0 +1,287 @@
+"""
+性能基准
+
+    # ANN 索引及向量压缩: 与 flat 精确检索对比 recall@k、检索延迟和每条向量的字节数
+    python server/benchmark.py index --synthetic 50000 --dim 1536
+    python server/benchmark.py index --store santi --specs '[{"type": "hnsw", "M": 32}]'
+    python server/benchmark.py index --store santi --specs '[{"type": "flat", "quantizer": "pq", "rerank": 4}]'
+
+    # 所有预设在小库上都能构建和检索(向量数少于 PQ 中心数等情况)
+    python server/benchmark.py presets --sizes 1 38 300
+
+    # 切片: 新旧 chunk_text_by_max_token 的输出一致性与耗时，先在内置的固定文本上断言一致
+    # 原实现在 100 个字符就超过 max_token 时无法前进，--max-token 不能小于 400
+    python server/benchmark.py chunker --file server/novels/santi.json
+"""
+import re
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from core.index_factory import build_index, index_nbytes, search_index
+
+
+DEFAULT_SPECS = [
+    {'type': 'flat'},
+    {'type': 'ivf_flat', 'nprobe': 8},
+    {'type': 'ivf_flat', 'nprobe': 32},
+    {'type': 'hnsw', 'M': 32, 'ef_search': 32},
+    {'type': 'hnsw', 'M': 32, 'ef_search': 128},
+    {'type': 'flat', 'quantizer': 'fp16'},
+    {'type': 'flat', 'quantizer': 'sq8'},
+    {'type': 'flat', 'quantizer': 'sq8', 'rerank': 2},
+    {'type': 'flat', 'quantizer': 'pq'},
+    {'type': 'flat', 'quantizer': 'pq', 'rerank': 4},
+    {'type': 'ivf_flat', 'quantizer': 'pq'},
+    {'type': 'hnsw', 'M': 32, 'quantizer': 'sq8', 'rerank': 2},
+]
+
+
+def synthetic_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    """聚类分布的单位向量，近似真实 embedding 的分布"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 100), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)] + \
+        0.3 * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def store_vectors(name: str) -> np.ndarray:
+    from core.vector_store import vector_stores
+    from core.index_factory import reconstruct_vectors
+    loaded = vector_stores.get(name)
+    # 压缩索引用另存的原始向量
+    if loaded.chunks.vectors is not None:
+        return np.asarray(loaded.chunks.vectors, dtype=np.float32)
+    return reconstruct_vectors(loaded.index, loaded.chunks.ids())
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: int = 1) -> np.ndarray:
+    """在库内向量上加噪声作为查询"""
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.integers(0, len(vectors), count)]
+    queries = queries + 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+    return np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def bench_index(vectors: np.ndarray, queries: np.ndarray, specs, k: int):
+    ids = np.arange(len(vectors), dtype=np.int64)
+    flat = build_index(vectors, ids, {'type': 'flat'})
+    truth = flat.search(queries, k)[1]
+    flat_nbytes = index_nbytes(flat)
+    rows = []
+    for spec in specs:
+        start = time.perf_counter()
+        index = build_index(vectors, ids, spec)
+        build_time = time.perf_counter() - start
+
+        latencies = []
+        found = []
+        # 单条查询逐个计时，与线上请求一致
+        for query in queries:
+            start = time.perf_counter()
+            found.append(search_index(index, query.reshape(1, -1), k, spec,
+                                      vectors=vectors, rows=int)[1][0])
+            latencies.append((time.perf_counter() - start) * 1000)
+        rows.append({
+            'spec': json.dumps(spec),
+            'build_s': round(build_time, 2),
+            'bytes_per_vector': round(index_nbytes(index) / len(vectors), 1),
+            'compression': round(flat_nbytes / index_nbytes(index), 1),
+            f'recall@{k}': round(recall_at_k(np.array(found), truth), 4),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        })
+    return rows
+
+
+def check_presets(specs, sizes, dim: int, k: int):
+    """每个预设在各个向量数下构建并检索一次，返回 (结果, 失败数)"""
+    rows = []
+    failures = 0
+    for n in sizes:
+        vectors = synthetic_vectors(n, dim)
+        ids = np.arange(n, dtype=np.int64)
+        for spec in specs:
+            try:
+                index = build_index(vectors, ids, spec)
+                found = search_index(index, vectors[:1], min(k, n), spec,
+                                     vectors=vectors, rows=int)[1]
+                status = 'ok' if found[0][0] >= 0 else 'empty result'
+            except Exception as e:
+                status = f'error: {e}'
+            failures += status != 'ok'
+            rows.append({'vectors': n, 'spec': json.dumps(spec), 'status': status})
+    return rows, failures
+
+
+# 原实现在 100 个字符就超过 max_token 时不再前进，会死循环
+# 一个字符最多 4 个 UTF-8 字节即最多 4 个 token，max_token 不小于 400 时总能前进
+CHUNKER_MIN_MAX_TOKEN = 400
+
+# 切片一致性自检用的固定文本: 中英文句子、小数、省略号及没有标点的长段落
+CHUNKER_SAMPLE = (
+    "汪淼觉得，来找他的这四个人是一个奇怪的组合。圆周率是3.14159，不是句号！"
+    "他抬头看了看天……什么也没有？" * 12
+    + "The countdown appeared again. It was 1.5 seconds faster than yesterday. " * 10
+    + "没有标点的长句子" * 60
+    + "最后一句话。"
+)
+
+
+def chunk_text_by_max_token_reference(text: str, max_token=512):
+    """原来的切片实现，逐步增长前缀并重复编码，仅用于对比"""
+    from core.utils import token_str
+    if token_str(text) <= max_token:
+        return [text]
+    res = []
+    steps = [400, 200, 100]
+    punctuation = r'(?<!\d)([。？！…?!]|\.(?=\s))(?!\d)'
+    while len(text) > 0:
+        split_pos = 0
+        while split_pos < len(text):
+            for step in steps:
+                next_step = min(step, len(text) - split_pos)
+                temp_text = text[:split_pos + next_step]
+                if token_str(temp_text) <= max_token:
+                    split_pos += next_step
+                    break
+            else:
+                break
+        if split_pos == 0:
+            raise ValueError(f"reference chunker cannot advance: 100 chars exceed max_token={max_token}")
+        search_res = re.search(punctuation, text[:split_pos][::-1])
+        if search_res:
+            split_pos = split_pos - int(search_res.end()) + 1
+        res.append(text[:split_pos])
+        text = text[split_pos:]
+    return res
+
+
+def check_chunker(max_tokens=(400, 512)):
+    """固定文本上新旧切片结果一致，且切片拼接后等于原文，不一致时抛出 AssertionError"""
+    from core.utils import chunk_text_by_max_token
+    for max_token in max_tokens:
+        expected = chunk_text_by_max_token_reference(CHUNKER_SAMPLE, max_token)
+        actual = chunk_text_by_max_token(CHUNKER_SAMPLE, max_token)
+        assert len(expected) > 1, f"sample fits in one chunk at max_token={max_token}"
+        assert ''.join(actual) == CHUNKER_SAMPLE, f"chunks lose text at max_token={max_token}"
+        assert actual == expected, f"chunks differ from the reference at max_token={max_token}"
+
+
+def max_token_arg(value: str) -> int:
+    max_token = int(value)
+    if max_token < CHUNKER_MIN_MAX_TOKEN:
+        raise argparse.ArgumentTypeError(
+            f"must be at least {CHUNKER_MIN_MAX_TOKEN}, the reference chunker cannot advance below it")
+    return max_token
+
+
+def novel_texts(path: str):
+    """小说 json 取每个章节的 content 和 plot 正文，txt 按整本处理"""
+    if not path.endswith('.json'):
+        with open(path, 'r', encoding='utf-8') as f:
+            return [f.read()]
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    texts = []
+    for chapter in data['chapter']:
+        if chapter.get('content'):
+            texts.append(chapter['content'])
+        texts.extend(plot.get('text', '') for plot in chapter.get('plots', []))
+    # 整本书拼成一段，模拟超长章节
+    texts.append(''.join(texts))
+    return [text for text in texts if text]
+
+
+def bench_chunker(texts, max_tokens):
+    from core.utils import chunk_text_by_max_token
+    rows = []
+    mismatches = 0
+    for max_token in max_tokens:
+        start = time.perf_counter()
+        expected = [chunk_text_by_max_token_reference(text, max_token) for text in texts]
+        reference_time = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = [chunk_text_by_max_token(text, max_token) for text in texts]
+        new_time = time.perf_counter() - start
+        equal = sum(a == e for a, e in zip(actual, expected))
+        mismatches += len(texts) - equal
+        rows.append({
+            'max_token': max_token,
+            'texts': len(texts),
+            'chars': sum(len(text) for text in texts),
+            'chunks': sum(len(chunks) for chunks in actual),
+            'identical': f"{equal}/{len(texts)}",
+            'reference_s': round(reference_time, 3),
+            'new_s': round(new_time, 3),
+            'speedup': round(reference_time / new_time, 1) if new_time else 0,
+        })
+    return rows, mismatches
+
+
+def print_rows(rows):
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    widths = {key: max(len(key), *(len(str(row[key])) for row in rows)) for key in keys}
+    print('  '.join(key.ljust(widths[key]) for key in keys))
+    for row in rows:
+        print('  '.join(str(row[key]).ljust(widths[key]) for key in keys))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TalkBoxServer benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help='ANN 索引 recall/延迟对比')
+    index_parser.add_argument('--store', default='', help='使用 embedding/<store> 的真实向量')
+    index_parser.add_argument('--synthetic', type=int, default=20000, help='合成向量条数')
+    index_parser.add_argument('--dim', type=int, default=1536)
+    index_parser.add_argument('--queries', type=int, default=200)
+    index_parser.add_argument('--k', type=int, default=25)
+    index_parser.add_argument('--specs', default='', help='JSON 格式的索引参数列表')
+
+    presets_parser = subparsers.add_parser('presets', help='小库上构建所有索引预设')
+    presets_parser.add_argument('--sizes', type=int, nargs='+', default=[1, 38, 300])
+    presets_parser.add_argument('--dim', type=int, default=1536)
+    presets_parser.add_argument('--k', type=int, default=25)
+    presets_parser.add_argument('--specs', default='', help='JSON 格式的索引参数列表')
+
+    chunker_parser = subparsers.add_parser('chunker', help='切片新旧实现一致性与耗时')
+    chunker_parser.add_argument('--file', default='novels/santi.json', help='小说 json 或 txt')
+    chunker_parser.add_argument('--max-token', type=max_token_arg, nargs='+', default=[400, 512, 1024],
+                                help=f'不小于 {CHUNKER_MIN_MAX_TOKEN}')
+
+    args = parser.parse_args()
+    if args.command == 'index':
+        vectors = store_vectors(args.store) if args.store \
+            else synthetic_vectors(args.synthetic, args.dim)
+        specs = json.loads(args.specs) if args.specs else DEFAULT_SPECS
+        queries = make_queries(vectors, args.queries)
+        print_rows(bench_index(vectors, queries, specs, args.k))
+    elif args.command == 'presets':
+        specs = json.loads(args.specs) if args.specs else DEFAULT_SPECS
+        rows, failures = check_presets(specs, args.sizes, args.dim, args.k)
+        print_rows(rows)
+        # 有预设构建失败时返回非 0，可用作回归检查
+        sys.exit(1 if failures else 0)
+    elif args.command == 'chunker':
+        # 先在固定文本上自检，新实现有回归时直接失败
+        check_chunker()
+        rows, mismatches = bench_chunker(novel_texts(args.file), args.max_token)
+        print_rows(rows)
+        # 输出不一致时返回非 0，可用作一致性测试
+        sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
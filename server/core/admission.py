@@ -0,0 +1,167 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from collections import deque
+
+from core.exception import Overloaded, UpstreamError
+from core.resilience import LatencyTracker
+
+
+# 同时进行的聊天请求数上限，以及排队等待的请求数上限
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 50))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 100))
+# 排队超过该秒数仍未轮到则拒绝
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 10))
+# 拒绝时返回的状态码和 Retry-After 秒数
+ADMISSION_REJECT_STATUS = int(os.getenv('ADMISSION_REJECT_STATUS', 503))
+ADMISSION_RETRY_AFTER = float(os.getenv('ADMISSION_RETRY_AFTER', 2))
+# 自适应并发(AIMD): 首 token 延迟不超过目标时并发上限缓慢增加，超过或上游限流时减半
+ADMISSION_ADAPTIVE = os.getenv('ADMISSION_ADAPTIVE', '0') == '1'
+ADMISSION_MIN_IN_FLIGHT = int(os.getenv('ADMISSION_MIN_IN_FLIGHT', 4))
+ADMISSION_TARGET_LATENCY = float(os.getenv('ADMISSION_TARGET_LATENCY', 3))
+
+# 视为上游过载的状态码
+CONGESTION_STATUSES = (429, 500, 502, 503, 504)
+
+# 当前请求占用的名额，用于记录首 token 延迟
+_ticket = contextvars.ContextVar('admission_ticket', default=None)
+
+
+class Ticket:
+    __slots__ = ('admitted', 'first_chunk')
+
+    def __init__(self):
+        self.admitted = time.monotonic()
+        self.first_chunk = None
+
+
+def mark_first_chunk():
+    """上游返回首个 chunk 时调用，作为自适应并发的延迟信号"""
+    ticket = _ticket.get()
+    if ticket is not None and ticket.first_chunk is None:
+        ticket.first_chunk = time.monotonic() - ticket.admitted
+
+
+class AdmissionController:
+    """
+    进程内的聊天请求准入控制，用法同 asyncio.Semaphore: async with controller: ...
+    - 进行中的请求达到上限后排队，队列满或排队超时立即抛出 Overloaded，由接口返回 503 和 Retry-After
+    - 开启自适应时按 AIMD 调整上限: 首 token 延迟达标时每轮加 1，超过目标或上游过载时减半
+    """
+
+    def __init__(self,
+                 max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+                 max_queue: int = ADMISSION_MAX_QUEUE,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+                 adaptive: bool = ADMISSION_ADAPTIVE,
+                 min_in_flight: int = ADMISSION_MIN_IN_FLIGHT,
+                 target_latency: float = ADMISSION_TARGET_LATENCY):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.adaptive = adaptive
+        self.min_in_flight = min(min_in_flight, max_in_flight)
+        self.target_latency = target_latency
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.waiters = deque()
+        self.last_decrease = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_time = LatencyTracker()
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < max(1, int(self.limit))
+
+    def _reject(self, reason: str):
+        logging.warning('chat admission rejected (%s): in_flight=%d limit=%d queued=%d',
+                        reason, self.in_flight, int(self.limit), len(self.waiters))
+        return Overloaded(status=ADMISSION_REJECT_STATUS, retry_after=ADMISSION_RETRY_AFTER)
+
+    async def acquire(self) -> Ticket:
+        start = time.monotonic()
+        if self._has_capacity() and not self.waiters:
+            self.in_flight += 1
+        else:
+            if len(self.waiters) >= self.max_queue:
+                self.rejected += 1
+                raise self._reject('queue full')
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            except BaseException as e:
+                if waiter.done() and not waiter.cancelled():
+                    # 已经分到名额后才超时或被取消，归还名额
+                    self.in_flight -= 1
+                    self._wake()
+                else:
+                    waiter.cancel()
+                    self.waiters.remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                    self.rejected += 1
+                    raise self._reject('queue timeout') from None
+                raise
+        self.admitted += 1
+        self.wait_time.add(time.monotonic() - start)
+        return Ticket()
+
+    def release(self, ticket: Ticket = None, error: BaseException = None):
+        self.in_flight -= 1
+        if self.adaptive and ticket is not None:
+            self._adjust(ticket, error)
+        self._wake()
+
+    def _wake(self):
+        """按空出的名额唤醒排队的请求，名额在唤醒前就计入 in_flight"""
+        while self.waiters and self._has_capacity():
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _adjust(self, ticket: Ticket, error: BaseException = None):
+        now = time.monotonic()
+        # 没有状态码的 UpstreamError 为超时或连接中断
+        congested = isinstance(error, UpstreamError) and \
+            error.status in CONGESTION_STATUSES + (None,)
+        latency = ticket.first_chunk
+        if congested or (latency is not None and latency > self.target_latency):
+            # 一个目标延迟的时间窗内只减一次，避免同一批慢请求把上限连续减半
+            if now - self.last_decrease >= self.target_latency:
+                self.limit = max(self.min_in_flight, self.limit / 2)
+                self.last_decrease = now
+                logging.info('chat admission limit decreased to %d', int(self.limit))
+        elif latency is not None:
+            # 每完成约 limit 个请求上限加 1
+            self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+
+    async def __aenter__(self):
+        ticket = await self.acquire()
+        _ticket.set(ticket)
+        return ticket
+
+    async def __aexit__(self, exc_type, exc, tb):
+        ticket = _ticket.get()
+        _ticket.set(None)
+        self.release(ticket, exc)
+
+    def stats(self) -> dict:
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'queued': len(self.waiters),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'queue_timeouts': self.timeouts,
+            'wait_p50': self.wait_time.percentile(50),
+            'wait_p95': self.wait_time.percentile(95),
+        }
+
+
+# 所有聊天请求共用，替代每个请求各自新建的 Semaphore
+chat_admission = AdmissionController()
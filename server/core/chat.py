@@ -1,11 +1,22 @@
 from typing import Dict, List, Tuple
 import json
 from core.utils import chunk_text_by_max_token, token_str
-import pickle
 import faiss
-from langchain.vectorstores import FAISS
+import numpy as np
 from langchain.embeddings import OpenAIEmbeddings
 from core.openai_prompt import OpenAI
+from core.openai_api import OPENAI_API_BASE
+from core.persona import personas
+from core.embedding_cache import EmbeddingCache
+from core.embedding_builder import EmbeddingBuilder
+from core.retrieval import RetrievalService
+from core.index_factory import build_index, normalize_spec, supports_remove, is_quantized, reconstruct_vectors
+from core.chunk_store import ChunkStore, CHUNK_TEXT, CHUNK_SUMMARY, chunk_hash
+from core.vector_store import INDEX_PATH, vector_stores, store_files, file_signature, convert_legacy_store
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
 from dotenv import load_dotenv
 import os
  
@@ -16,10 +27,13 @@ api_keys = os.getenv('API_KEYS').split(',')
 
 openai = OpenAI(api_keys=api_keys)
 OPENAI_API_KEY = api_keys[0]
-
-# 存向量的文件夹
-INDEX_PATH = os.path.join(os.getcwd(), 'embedding')
-os.makedirs(INDEX_PATH, exist_ok=True)
+# 查询向量缓存，重复的问题不再请求 embeddings 接口
+query_embedding = EmbeddingCache(OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY,
+                                                  openai_api_base=OPENAI_API_BASE))
+# 异步检索服务，chat 请求的检索不阻塞 IOLoop
+retrieval = RetrievalService(query_embedding)
+# 构建索引用的批量 embedding，检查点保存在索引目录下
+embedding_builder = EmbeddingBuilder(api_keys, INDEX_PATH)
 
 
 # 将paragraphs中图标的文本提取出来,整理paragraphs
@@ -32,68 +46,156 @@ def format_paragraphs(paragraphs: list) -> List[str]:
             res.append(paragraph.get('text', ''))
     return res
 
-# 将文本转换成向量存储
-def embedding_paper(json_path: str = '', chunk_size=512):
-    json_name = json_path.split('/')[-1].replace('.json', '')
-    # 如果已经存在索引文件，则不再重复生成
-    if os.path.exists(os.path.join(INDEX_PATH, f"{json_name}.pkl")):
-        return
-    with open(json_path, 'r',encoding='utf-8') as f:
-        data = json.load(f)
+# 将小说json整理成段落和切片
+def parse_paper(data: dict) -> Tuple[List[Dict], List[Tuple[int, str, int]]]:
     chapters = data['chapter'].copy()
-    
-    section_id = 0
-    infos = []
-    metadatas = []
+
+    sections = []
+    chunks = []
     for chapter in chapters:
 
         plots = chapter.get('plots', [])
         title = chapter.get('title', '')
 
         for plot in plots:
-            section_id += 1
+            section_idx = len(sections)
             text = plot.get('text', '')
             embeddings = plot.get('embeddings', [])
-            chunks = chunk_text_by_max_token(text)
-            for chunk in chunks:
-                infos.append(chunk)
-                metadatas.append({
-                    'section_id': section_id,
-                    'section_title': title,
-                    'summary': '\n'.join(embeddings),
-                    'text': text,
-                    'chunk_text': chunk
-                })
+            # 每个段落的正文和摘要只保存一次，切片只记录偏移
+            sections.append({
+                'title': title,
+                'summary': '\n'.join(embeddings),
+                'text': text,
+            })
+            for chunk in chunk_text_by_max_token(text):
+                chunks.append((section_idx, chunk, CHUNK_TEXT))
             for embedding in embeddings:
-                infos.append(embedding)
-                metadatas.append({
-                    'section_id': section_id,
-                    'section_title': title,
-                    'summary': '\n'.join(embeddings),
-                    'text': text,
-                    'chunk_text': embedding
-                })
-
-    openaiEmbedding = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
-
-    store = FAISS.from_texts(infos,
-                            openaiEmbedding,
-                            metadatas=metadatas)
+                chunks.append((section_idx, embedding, CHUNK_SUMMARY))
+    return sections, chunks
+
+
+# 将文本转换成向量存储
+# index_spec 选择索引类型及参数，见 core.index_factory，默认取 INDEX_SPEC
+def embedding_paper(json_path: str = '', chunk_size=512, index_spec: Dict = None):
+    json_name = json_path.split('/')[-1].replace('.json', '')
+    prefix = os.path.join(INDEX_PATH, json_name)
+    with open(json_path, 'rb') as f:
+        raw = f.read()
+    meta = {
+        'source_digest': hashlib.sha1(raw).hexdigest(),
+        'index': normalize_spec(index_spec),
+    }
+
+    # 旧版 pkl 索引先转换，避免重新 embedding 整本书
+    if file_signature(store_files(json_name)) is None:
+        convert_legacy_store(json_name)
+    exists = file_signature(store_files(json_name)) is not None
+    if exists:
+        old_chunks = ChunkStore.open(prefix)
+        # 小说内容和索引类型都没有变化，则不再重复生成
+        if old_chunks.meta.get('source_digest') == meta['source_digest'] \
+                and old_chunks.meta.get('index', meta['index']) == meta['index']:
+            return
+
+    sections, chunks = parse_paper(json.loads(raw.decode('utf-8')))
+    if exists:
+        update_paper_index(json_name, old_chunks, sections, chunks, meta)
+        return
+
+    infos = [chunk_text for _, chunk_text, _ in chunks]
     # 将文本转换成向量
-    # aka = OpenAIEmbeddings(openai_api_base="https://api.aios.chat/v1/",openai_api_key=OPENAI_API_KEY)
-    #一次性将所有的infos 与 metadatas打包发送，会被限速
-    
+    # 一次性将所有的infos打包发送会被限速，这里分批并发发送到所有key上，并按批保存检查点
+    vectors = embedding_builder.embed(json_name, infos)
+    # 带 id 的索引，增量更新时按 id 删除过期向量
+    index = build_index(vectors, np.arange(len(chunks), dtype=np.int64), meta['index'])
+
+    # 保存切片库和索引文件，索引最后写入；压缩索引另存原始向量
+    ChunkStore.write(prefix, sections, chunks, meta=meta,
+                     vectors=vectors if is_quantized(meta['index']) else None)
+    faiss.write_index(index, f"{prefix}.index")
+    embedding_builder.clear(json_name)
+
+
+# 增量更新索引: 按内容哈希复用未变化切片的向量，只 embedding 新增或修改的切片
+def update_paper_index(json_name: str, old_chunks: ChunkStore, sections, chunks, meta):
+    prefix = os.path.join(INDEX_PATH, json_name)
+    index = faiss.read_index(f"{prefix}.index")
+    if isinstance(index, faiss.IndexFlat):
+        # 旧索引没有 id 映射，向量 id 即行号
+        vectors = index.reconstruct_n(0, index.ntotal)
+        index = build_index(vectors, old_chunks.ids(), {'type': 'flat'})
+
+    reusable = defaultdict(list)
+    for chunk_id, content_hash in zip(old_chunks.ids(), old_chunks.hashes()):
+        reusable[int(content_hash)].append(int(chunk_id))
+    next_id = int(old_chunks.ids().max()) + 1 if len(old_chunks) else 0
+
+    ids = []
+    new_ids = []
+    new_texts = []
+    for _, chunk_text, _ in chunks:
+        candidates = reusable.get(chunk_hash(chunk_text))
+        if candidates:
+            ids.append(candidates.pop(0))
+            continue
+        ids.append(next_id)
+        new_ids.append(next_id)
+        new_texts.append(chunk_text)
+        next_id += 1
+    stale_ids = [chunk_id for candidates in reusable.values() for chunk_id in candidates]
+    logging.info('update index %s: %d new, %d stale, %d kept', json_name,
+                 len(new_ids), len(stale_ids), len(ids) - len(new_ids))
+
+    vectors = embedding_builder.embed(json_name, new_texts) if new_texts \
+        else np.zeros((0, index.d), dtype=np.float32)
+    new_id_set = set(new_ids)
+    keep_ids = [chunk_id for chunk_id in ids if chunk_id not in new_id_set]
+    new_ids = np.array(new_ids, dtype=np.int64)
+    # 换了索引类型或索引不支持删除(HNSW)时需要重建
+    rebuild = old_chunks.meta.get('index', meta['index']) != meta['index'] or not supports_remove(index)
+    kept_vectors = None
+    if rebuild or is_quantized(meta['index']):
+        kept_vectors = saved_vectors(index, old_chunks, keep_ids)
+    if rebuild:
+        logging.info('rebuild %s index %s', meta['index']['type'], json_name)
+        index = build_index(np.vstack([kept_vectors, vectors]),
+                            np.concatenate([np.array(keep_ids, dtype=np.int64), new_ids]),
+                            meta['index'])
+    else:
+        if stale_ids:
+            index.remove_ids(np.array(stale_ids, dtype=np.int64))
+        if len(new_ids):
+            index.add_with_ids(vectors, new_ids)
 
-    # 保存索引文件
-    faiss.write_index(store.index,
-                    os.path.join(INDEX_PATH, f"{json_name}.index"))
-    store.index = None
-    with open(os.path.join(INDEX_PATH, f"{json_name}.pkl"), "wb") as f:
-        pickle.dump(store, f)
+    raw_vectors = None
+    if is_quantized(meta['index']):
+        # 压缩索引另存与切片逐行对应的原始向量
+        by_id = dict(zip(keep_ids, kept_vectors))
+        by_id.update(zip(new_ids.tolist(), vectors))
+        raw_vectors = np.vstack([by_id[chunk_id] for chunk_id in ids])
+
+    ChunkStore.write(prefix, sections, chunks, ids=ids, meta=meta, vectors=raw_vectors)
+    faiss.write_index(index, f"{prefix}.index")
+    embedding_builder.clear(json_name)
+
+
+# 取回保留切片的原始向量: 优先读另存的原始向量，否则从索引还原
+def saved_vectors(index, old_chunks: ChunkStore, keep_ids: List[int]) -> np.ndarray:
+    if old_chunks.vectors is not None:
+        rows = [old_chunks.row(chunk_id) for chunk_id in keep_ids]
+        return np.asarray(old_chunks.vectors[rows], dtype=np.float32).reshape(-1, index.d)
+    return reconstruct_vectors(index, keep_ids)
+
+
+# 并行构建多本小说的索引，embedding 请求共用同一个 key 池
+def embedding_papers(json_paths: List[str], max_workers: int = 2):
+    with ThreadPoolExecutor(max_workers) as executor:
+        list(executor.map(embedding_paper, json_paths))
 
 from langchain.chat_models import ChatOpenAI
 
 llm = ChatOpenAI(openai_api_key=OPENAI_API_KEY,
+                 openai_api_base=OPENAI_API_BASE,
                  temperature=0.9,
                  request_timeout=6000,
                  max_tokens=1000)  # type: ignore
@@ -112,41 +214,57 @@ def search_query_from_vector_db(json_path,
                                 max_tokens: int = 8000,
                                 thereshold: float = 0.6) -> (str, Dict):
     json_name = json_path.split('/')[-1].replace('.json', '')
-    # 载入索引文件
-    print(os.path.join(INDEX_PATH, f"{json_name}.pkl"))
-    if not os.path.exists(os.path.join(
-            INDEX_PATH, f"{json_name}.pkl")) or not os.path.exists(
-        os.path.join(INDEX_PATH, f"{json_name}.index")):
-        raise Exception("索引文件不存在")
-    with open(os.path.join(INDEX_PATH, f"{json_name}.pkl"), "rb") as f:
-        VectorDBStorePapers: FAISS = pickle.load(f)
-    vectorDBIndexPapers = faiss.read_index(
-        os.path.join(INDEX_PATH, f"{json_name}.index"))
-    VectorDBStorePapers.index = vectorDBIndexPapers
+    # 从进程内缓存取索引，首次使用或文件变化时才从磁盘载入
+    loaded = vector_stores.get(json_name)
     # 搜索
-    search_results = VectorDBStorePapers.similarity_search_with_score(query,
-                                                                      k=k)
+    query_vector = query_embedding.embed_query(query).reshape(1, -1)
+    scores, ids = loaded.search(query_vector, k)
+    return format_search_results(loaded, scores, ids, max_tokens)
+
+
+# 异步检索，阻塞的部分都在检索线程池中执行，并发查询合并成一次 faiss 检索
+async def search_query(json_path,
+                       query: str,
+                       k: int = 25,
+                       max_tokens: int = 8000) -> (str, Dict):
+    json_name = json_path.split('/')[-1].replace('.json', '')
+    loaded, scores, ids = await retrieval.search(json_name, query, k)
+    return await retrieval.run(format_search_results, loaded, scores, ids, max_tokens)
+
+
+# 按段落合并检索结果，并拼接成不超过 max_tokens 的上下文
+def format_search_results(loaded, scores, ids, max_tokens: int = 8000) -> (str, Dict):
     res_dict = {}
-    for result in search_results:
-        doc = result[0]
-        score = result[1]
-        section_id = doc.metadata['section_id']
-        chunk_text = doc.metadata['chunk_text']
-        summary = doc.metadata['summary']
-        if chunk_text in summary:
-            chunk_text = ''
-        section_title = doc.metadata['section_title']
-        text = doc.metadata['text']
+    for score, i in zip(scores[0], ids[0]):
+        if i < 0:
+            continue
+        score = float(score)
+        try:
+            row = loaded.chunks.row(i)
+        except KeyError:
+            # 索引与切片库不一致，跳过不存在的切片
+            logging.warning('chunk id %d not found in chunk store', i)
+            continue
+        section_idx = loaded.chunks.chunk_section(row)
+        section_id = section_idx + 1
+        chunk_text = loaded.chunks.chunk_text(row)
         if section_id not in res_dict:
+            # 只解码命中的段落
+            section = loaded.chunks.section(section_idx)
+            summary = section['summary']
+            if chunk_text in summary:
+                chunk_text = ''
             res_dict[section_id] = {
                 'score':
                     int(l2_distance_to_cosine_similarity(score) * 100) / 100,
                 'summary': summary,
-                'text': text,
-                'section_title': section_title,
+                'text': section['text'],
+                'section_title': section['section_title'],
                 'searched_texts': [chunk_text],
             }
         else:
+            if chunk_text in res_dict[section_id]['summary']:
+                chunk_text = ''
             searched_texts = res_dict[section_id]['searched_texts']
             if chunk_text not in searched_texts:
                 searched_texts.append(chunk_text)
@@ -160,7 +278,15 @@ def search_query_from_vector_db(json_path,
         sorted(res_dict.items(),
                key=lambda item: item[1]['score'],
                reverse=True))
-    final_text = ''
+    return pack_search_results(res_dict, max_tokens), res_dict
+
+
+# 按分数顺序拼接段落直到 max_tokens
+# 每段以换行结尾、下一段以字母开头，tiktoken 预分词在段落边界处断开，
+# 所以整体 token 数等于各段 token 数之和，每段只需编码一次
+def pack_search_results(res_dict: Dict, max_tokens: int = 8000) -> str:
+    parts = []
+    total_tokens = 0
     for section_id, section in res_dict.items():
         current_format_text = ''
         current_format_text += 'section_title: ' + section[
@@ -171,10 +297,12 @@ def search_query_from_vector_db(json_path,
             if searched_text != '':
                 current_format_text += f"{searched_text}\n"
         current_format_text += '\n'
-        if token_str(final_text + current_format_text) > max_tokens:
+        current_tokens = token_str(current_format_text)
+        if total_tokens + current_tokens > max_tokens:
             break
-        final_text += current_format_text
-    return final_text, res_dict
+        total_tokens += current_tokens
+        parts.append(current_format_text)
+    return ''.join(parts)
 
 
 async def chat_book(
@@ -183,20 +311,41 @@ async def chat_book(
     role_desc_path: str,
     book_name: str,
     role_name: str,
-    query: str
+    query: str,
+    **limits
 ) -> None:
-    role_desc = open(role_desc_path, 'r', encoding='utf-8').read()
+    # 人设缓存在内存中，文件修改后自动重新载入
+    persona = await personas.get(role_desc_path, book_name, role_name)
     if parse_json_path != "":
         # optimized_query = await openai.optimize_query(openAI_semaphore,query)
         # 从索引中搜索
-        search_texts, search_results = search_query_from_vector_db(
-            parse_json_path, query)
+        search_texts, search_results = await search_query(parse_json_path, query)
 
         res = await openai.generate_answer_by_search_results(
-            openAI_semaphore, search_texts, query, book_name, role_name,role_desc)
+            openAI_semaphore, search_texts, query, book_name, role_name, persona.description,
+            persona=persona, **limits)
 
         #print(res)
         return res
 
 
+async def chat_book_stream(
+    openAI_semaphore,
+    parse_json_path: str,
+    role_desc_path: str,
+    book_name: str,
+    role_name: str,
+    query: str,
+    **limits
+):
+    """chat_book 的流式版本，逐段返回回复"""
+    persona = await personas.get(role_desc_path, book_name, role_name)
+    if parse_json_path != "":
+        search_texts, search_results = await search_query(parse_json_path, query)
+        async for delta in openai.stream_answer_by_search_results(
+                openAI_semaphore, search_texts, query, book_name, role_name, persona.description,
+                persona=persona, **limits):
+            yield delta
+
+
 #    asyncio.run(main('novels/', "santi", "ye"))
@@ -0,0 +1,223 @@
+import os
+import mmap
+import json
+import hashlib
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+# 段落表: 标题、摘要、正文在文本块中的字节偏移与长度
+SECTION_DTYPE = np.dtype([
+    ('title_off', '<i8'), ('title_len', '<i4'),
+    ('summary_off', '<i8'), ('summary_len', '<i4'),
+    ('text_off', '<i8'), ('text_len', '<i4'),
+])
+
+# 切片表: id 即向量在索引中的 id，hash 为切片文本的内容哈希，用于增量更新
+CHUNK_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('hash', '<u8'),
+    ('section', '<i4'),
+    ('kind', '<i1'),
+    ('off', '<i8'), ('len', '<i4'),
+])
+
+CHUNK_TEXT = 0
+CHUNK_SUMMARY = 1
+
+
+def chunk_files(prefix: str):
+    """返回 (段落表, 切片表, 文本块) 文件路径"""
+    return (f"{prefix}.sections.npy", f"{prefix}.chunks.npy", f"{prefix}.blob")
+
+
+def vectors_file(prefix: str) -> str:
+    return f"{prefix}.vectors.npy"
+
+
+def chunk_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class ChunkStore:
+    """
+    按列存储的切片库，替代 pickle 的 LangChain docstore
+    - 所有文本只在一个 UTF-8 文本块中保存一次，切片记录的是偏移
+    - 三个文件都以只读 mmap 打开，检索时只解码命中的段落
+    """
+
+    def __init__(self, sections: np.ndarray, chunks: np.ndarray, blob, meta: Dict = None,
+                 vectors: np.ndarray = None):
+        self.sections = sections
+        self.chunks = chunks
+        self.blob = blob
+        self.meta = meta or {}
+        # 与切片表逐行对应的原始向量，只有压缩索引才保存，用于精排和重建
+        self.vectors = vectors
+        # 按 id 排序的行号及排好序的 id，首次查找时生成
+        self._id_order = None
+        self._sorted_ids = None
+
+    @classmethod
+    def open(cls, prefix: str) -> 'ChunkStore':
+        sections_path, chunks_path, blob_path = chunk_files(prefix)
+        sections = np.load(sections_path, mmap_mode='r')
+        chunks = np.load(chunks_path, mmap_mode='r')
+        with open(blob_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                blob = b''
+            else:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        meta = {}
+        if os.path.exists(f"{prefix}.meta.json"):
+            with open(f"{prefix}.meta.json", 'r') as f:
+                meta = json.load(f)
+        vectors = None
+        if os.path.exists(vectors_file(prefix)):
+            vectors = np.load(vectors_file(prefix), mmap_mode='r')
+        return cls(sections, chunks, blob, meta, vectors)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def nbytes(self) -> int:
+        return self.sections.nbytes + self.chunks.nbytes + len(self.blob)
+
+    def _text(self, off, length) -> str:
+        return bytes(self.blob[off:off + length]).decode('utf-8')
+
+    def ids(self) -> np.ndarray:
+        # 没有 id 列的旧切片表，id 即行号
+        if 'id' not in self.chunks.dtype.names:
+            return np.arange(len(self.chunks), dtype=np.int64)
+        return self.chunks['id']
+
+    def hashes(self) -> np.ndarray:
+        if 'hash' not in self.chunks.dtype.names:
+            return np.array([chunk_hash(self.chunk_text(i)) for i in range(len(self))],
+                            dtype=np.uint64)
+        return self.chunks['hash']
+
+    def row(self, chunk_id: int) -> int:
+        """向量 id 对应的切片行号，id 不存在时抛出 KeyError"""
+        if self._id_order is None:
+            ids = np.asarray(self.ids())
+            self._id_order = np.argsort(ids, kind='stable')
+            self._sorted_ids = ids[self._id_order]
+        pos = int(np.searchsorted(self._sorted_ids, chunk_id))
+        if pos >= len(self._sorted_ids) or self._sorted_ids[pos] != chunk_id:
+            raise KeyError(f"chunk id {chunk_id} not found")
+        return int(self._id_order[pos])
+
+    def chunk_text(self, i: int) -> str:
+        chunk = self.chunks[i]
+        return self._text(int(chunk['off']), int(chunk['len']))
+
+    def chunk_section(self, i: int) -> int:
+        return int(self.chunks[i]['section'])
+
+    def section(self, section: int) -> Dict:
+        row = self.sections[section]
+        return {
+            'section_id': section + 1,
+            'section_title': self._text(int(row['title_off']), int(row['title_len'])),
+            'summary': self._text(int(row['summary_off']), int(row['summary_len'])),
+            'text': self._text(int(row['text_off']), int(row['text_len'])),
+        }
+
+    @staticmethod
+    def write(prefix: str,
+              sections: List[Dict],
+              chunks: List[Tuple[int, str, int]],
+              ids: List[int] = None,
+              meta: Dict = None,
+              vectors: np.ndarray = None):
+        """
+        sections: [{'title', 'summary', 'text'}]
+        chunks: [(段落下标, 切片文本, 类型)]
+        ids: 每个切片的向量 id，默认为行号
+        vectors: 与 chunks 逐行对应的原始向量，为 None 时不保存
+        """
+        if ids is None:
+            ids = range(len(chunks))
+        blob = bytearray()
+        section_rows = []
+        chunk_rows = []
+
+        def append(text: str):
+            data = text.encode('utf-8')
+            off = len(blob)
+            blob.extend(data)
+            return off, len(data)
+
+        sources = []
+        for section in sections:
+            title_off, title_len = append(section['title'])
+            summary_off, summary_len = append(section['summary'])
+            text_off, text_len = append(section['text'])
+            section_rows.append((title_off, title_len, summary_off, summary_len,
+                                 text_off, text_len))
+            sources.append({CHUNK_TEXT: (section['text'], text_off),
+                            CHUNK_SUMMARY: (section['summary'], summary_off)})
+
+        # 切片都是正文或摘要的子串，只记录偏移；按顺序向后查找，保持线性
+        cursors = {}
+        for chunk_id, (section_idx, chunk_text, kind) in zip(ids, chunks):
+            source, base_off = sources[section_idx][kind]
+            char_pos, byte_pos = cursors.get((section_idx, kind), (0, 0))
+            pos = source.find(chunk_text, char_pos)
+            if pos < 0:
+                char_pos, byte_pos = 0, 0
+                pos = source.find(chunk_text)
+            if pos < 0:
+                off, length = append(chunk_text)
+            else:
+                byte_pos += len(source[char_pos:pos].encode('utf-8'))
+                off = base_off + byte_pos
+                length = len(chunk_text.encode('utf-8'))
+                cursors[(section_idx, kind)] = (pos, byte_pos)
+            chunk_rows.append((chunk_id, chunk_hash(chunk_text), section_idx, kind, off, length))
+
+        sections_path, chunks_path, blob_path = chunk_files(prefix)
+        # 先写临时文件再替换，避免读到写了一半的文件
+        with open(blob_path + '.tmp', 'wb') as f:
+            f.write(blob)
+        with open(sections_path + '.tmp', 'wb') as f:
+            np.save(f, np.array(section_rows, dtype=SECTION_DTYPE))
+        with open(chunks_path + '.tmp', 'wb') as f:
+            np.save(f, np.array(chunk_rows, dtype=CHUNK_DTYPE))
+        with open(f"{prefix}.meta.json.tmp", 'w') as f:
+            json.dump(meta or {}, f)
+        paths = [blob_path, sections_path, chunks_path, f"{prefix}.meta.json"]
+        if vectors is not None:
+            with open(vectors_file(prefix) + '.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+            paths.append(vectors_file(prefix))
+        elif os.path.exists(vectors_file(prefix)):
+            os.remove(vectors_file(prefix))
+        for path in paths:
+            os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def convert_langchain(prefix: str, store) -> None:
+        """把旧版 pickle 的 LangChain FAISS docstore 转换成切片库，向量顺序不变"""
+        logging.info('convert langchain docstore %s', prefix)
+        section_index = {}
+        sections = []
+        chunks = []
+        for i in range(len(store.index_to_docstore_id)):
+            metadata = store.docstore.search(store.index_to_docstore_id[i]).metadata
+            section_id = metadata['section_id']
+            if section_id not in section_index:
+                section_index[section_id] = len(sections)
+                sections.append({
+                    'title': metadata['section_title'],
+                    'summary': metadata['summary'],
+                    'text': metadata['text'],
+                })
+            chunk_text = metadata['chunk_text']
+            kind = CHUNK_TEXT if chunk_text in metadata['text'] else CHUNK_SUMMARY
+            chunks.append((section_index[section_id], chunk_text, kind))
+        ChunkStore.write(prefix, sections, chunks)
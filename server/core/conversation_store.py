@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from core.token_budget import Conversation
+
+
+# 对话存储: memory 为进程内存储，sqlite 为多进程共享的本地存储
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', 'memory')
+CONVERSATION_STORE_PATH = os.getenv('CONVERSATION_STORE_PATH', 'conversations.sqlite3')
+# 最多保留的对话数，超出后淘汰最久未访问的
+CONVERSATION_MAX_ENTRIES = int(os.getenv('CONVERSATION_MAX_ENTRIES', 10000))
+# 对话空闲超过这个秒数后淘汰
+CONVERSATION_TTL = float(os.getenv('CONVERSATION_TTL', 1800))
+# 进程内存储的内存上限，0 表示只按条数限制
+CONVERSATION_MEMORY_MB = float(os.getenv('CONVERSATION_MEMORY_MB', 0))
+
+
+class MemoryConversationStore:
+    """
+    进程内的对话存储，按 convo_id 存取 Conversation
+    - 按最近访问排序，空闲超过 ttl、条数或内存超限时淘汰最久未访问的
+    - 调用方用完后 release，立即释放
+    """
+
+    def __init__(self,
+                 max_entries: int = CONVERSATION_MAX_ENTRIES,
+                 ttl: float = CONVERSATION_TTL,
+                 memory_mb: float = CONVERSATION_MEMORY_MB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory_budget = int(memory_mb * 1024 * 1024)
+        self._entries = OrderedDict()  # convo_id -> (conversation, 最近访问时间, 字节数)
+        self.nbytes = 0
+        self.released = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, convo_id: str) -> bool:
+        self._expire()
+        return convo_id in self._entries
+
+    def __getitem__(self, convo_id: str) -> Conversation:
+        self._expire()
+        conversation, _, nbytes = self._entries[convo_id]
+        self._entries[convo_id] = (conversation, time.time(), nbytes)
+        self._entries.move_to_end(convo_id)
+        return conversation
+
+    def __setitem__(self, convo_id: str, conversation: Conversation):
+        self._remove(convo_id)
+        nbytes = conversation.nbytes()
+        self._entries[convo_id] = (conversation, time.time(), nbytes)
+        self.nbytes += nbytes
+        self._expire()
+        while len(self._entries) > self.max_entries or \
+                (self.memory_budget and self.nbytes > self.memory_budget and len(self._entries) > 1):
+            self._remove(next(iter(self._entries)))
+            self.evicted += 1
+
+    def _remove(self, convo_id: str) -> bool:
+        entry = self._entries.pop(convo_id, None)
+        if entry is None:
+            return False
+        self.nbytes -= entry[2]
+        return True
+
+    def _expire(self):
+        # 按访问时间排序，从最旧的开始检查
+        deadline = time.time() - self.ttl
+        while self._entries:
+            convo_id, (_, accessed, _) = next(iter(self._entries.items()))
+            if accessed > deadline:
+                break
+            self._remove(convo_id)
+            self.expired += 1
+
+    def release(self, convo_id: str):
+        if self._remove(convo_id):
+            self.released += 1
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'memory',
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'released': self.released,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+
+class SqliteConversationStore:
+    """
+    sqlite 对话存储，同一台机器上的多个 worker 共享多轮对话状态
+    接口与 MemoryConversationStore 相同，对话连同 token 数序列化为 json
+    """
+
+    # 两次清理过期对话的最小间隔秒数
+    sweep_interval = 60
+
+    def __init__(self,
+                 path: str = CONVERSATION_STORE_PATH,
+                 max_entries: int = CONVERSATION_MAX_ENTRIES,
+                 ttl: float = CONVERSATION_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.released = 0
+        self.expired = 0
+        self.evicted = 0
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        首次使用时才连接，多进程 fork 后按 pid 各自连接
+        sqlite 连接不能跨 fork 使用，模块导入时就连接会被所有 worker 共用
+        """
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversation '
+                '(convo_id TEXT PRIMARY KEY, data TEXT, accessed REAL)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS conversation_accessed ON conversation (accessed)')
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM conversation').fetchone()[0]
+
+    def __contains__(self, convo_id: str) -> bool:
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM conversation WHERE convo_id = ? AND accessed > ?',
+                (convo_id, time.time() - self.ttl)).fetchone()
+        return row is not None
+
+    def __getitem__(self, convo_id: str) -> Conversation:
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT data FROM conversation WHERE convo_id = ? AND accessed > ?',
+                (convo_id, now - self.ttl)).fetchone()
+            if row is not None:
+                self.conn.execute('UPDATE conversation SET accessed = ? WHERE convo_id = ?',
+                                   (now, convo_id))
+                self.conn.commit()
+        if row is None:
+            raise KeyError(convo_id)
+        return Conversation.from_dict(json.loads(row[0]))
+
+    def __setitem__(self, convo_id: str, conversation: Conversation):
+        data = json.dumps(conversation.to_dict(), ensure_ascii=False)
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO conversation (convo_id, data, accessed) VALUES (?, ?, ?)',
+                (convo_id, data, time.time()))
+            self.conn.commit()
+        self._sweep()
+
+    def _sweep(self):
+        """定期删除过期的对话和超出条数的最旧对话"""
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        try:
+            with self._lock:
+                expired = self.conn.execute('DELETE FROM conversation WHERE accessed <= ?',
+                                             (now - self.ttl, )).rowcount
+                evicted = self.conn.execute(
+                    'DELETE FROM conversation WHERE convo_id IN ('
+                    'SELECT convo_id FROM conversation ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries, )).rowcount
+                self.conn.commit()
+            self.expired += expired
+            self.evicted += evicted
+        except sqlite3.Error as e:
+            logging.warning('conversation store sweep failed: %s', e)
+
+    def release(self, convo_id: str):
+        with self._lock:
+            released = self.conn.execute('DELETE FROM conversation WHERE convo_id = ?',
+                                          (convo_id, )).rowcount
+            self.conn.commit()
+        self.released += released
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, nbytes = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM conversation').fetchone()
+        return {
+            'backend': 'sqlite',
+            'entries': entries,
+            'nbytes': nbytes,
+            'released': self.released,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+
+def make_conversation_store(backend: str = CONVERSATION_STORE):
+    if backend == 'memory':
+        return MemoryConversationStore()
+    if backend == 'sqlite':
+        return SqliteConversationStore()
+    raise ValueError(f"unknown conversation store {backend}, expected memory or sqlite")
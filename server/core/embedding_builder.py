@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import random
+import shutil
+import hashlib
+import logging
+import threading
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain.embeddings import OpenAIEmbeddings
+
+from core.openai_api import OPENAI_API_BASE
+
+
+# 每批发送给 embeddings 接口的文本条数
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 100))
+# 每个 key 同时进行的请求数
+EMBEDDING_CONCURRENCY_PER_KEY = int(os.getenv('EMBEDDING_CONCURRENCY_PER_KEY', 2))
+# 单批失败后的最大重试次数
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 6))
+
+
+def is_rate_limited(e: Exception) -> bool:
+    return getattr(e, 'http_status', None) == 429 or type(e).__name__ == 'RateLimitError'
+
+
+class KeyPool:
+    """
+    embeddings 请求的 key 池
+    - 每个 key 限制并发数
+    - 被限速(429)的 key 冷却一段时间，期间不再分配
+    """
+
+    def __init__(self, api_keys: List[str], concurrency_per_key: int):
+        self.concurrency_per_key = concurrency_per_key
+        self.in_flight = {key: 0 for key in api_keys}
+        self.cooldown_until = {key: 0.0 for key in api_keys}
+        self._cond = threading.Condition()
+
+    def acquire(self) -> str:
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = [key for key, count in self.in_flight.items()
+                         if count < self.concurrency_per_key and self.cooldown_until[key] <= now]
+                if ready:
+                    key = min(ready, key=lambda k: self.in_flight[k])
+                    self.in_flight[key] += 1
+                    return key
+                # 只看尚未结束的冷却，没有冷却中的 key 时等其他批次完成
+                deadlines = [t for t in self.cooldown_until.values() if t > now]
+                self._cond.wait(timeout=min(deadlines) - now if deadlines else None)
+
+    def release(self, key: str, cooldown: float = 0):
+        with self._cond:
+            self.in_flight[key] -= 1
+            if cooldown:
+                self.cooldown_until[key] = max(self.cooldown_until[key], time.time() + cooldown)
+            self._cond.notify_all()
+
+
+class EmbeddingBuilder:
+    """
+    构建索引时的批量 embedding
+    - 按固定大小分批，分散到 API_KEYS 的所有 key 上并发请求
+    - 每批完成后写入 <name>.build/ 检查点，中断后重新构建时跳过已完成的批次
+    """
+
+    def __init__(self,
+                 api_keys: List[str],
+                 checkpoint_path: str,
+                 batch_size: int = EMBEDDING_BATCH_SIZE,
+                 concurrency_per_key: int = EMBEDDING_CONCURRENCY_PER_KEY,
+                 max_retries: int = EMBEDDING_MAX_RETRIES):
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.keys = KeyPool(api_keys, concurrency_per_key)
+        # 重试和换 key 由这里处理，关掉 LangChain 自带的重试
+        self.clients = {
+            key: OpenAIEmbeddings(openai_api_key=key, openai_api_base=OPENAI_API_BASE,
+                                  chunk_size=batch_size, max_retries=1)
+            for key in api_keys
+        }
+        self.executor = ThreadPoolExecutor(len(api_keys) * concurrency_per_key)
+
+    def _checkpoint_dir(self, name: str, texts: List[str]) -> str:
+        """检查点目录，文本或批大小变化时清空重来"""
+        path = os.path.join(self.checkpoint_path, f"{name}.build")
+        digest = hashlib.sha1('\0'.join(texts).encode('utf-8')).hexdigest()
+        manifest = {'digest': digest, 'batch_size': self.batch_size, 'count': len(texts)}
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                if json.load(f) == manifest:
+                    return path
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        return path
+
+    def _embed_batch(self, path: str, batch_id: int, texts: List[str]) -> np.ndarray:
+        batch_path = os.path.join(path, f"batch_{batch_id:06d}.npy")
+        if os.path.exists(batch_path):
+            return np.load(batch_path)
+        for attempt in range(self.max_retries + 1):
+            key = self.keys.acquire()
+            cooldown = 0
+            try:
+                vectors = np.array(self.clients[key].embed_documents(texts), dtype=np.float32)
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    self.keys.release(key)
+                    raise
+                # 指数退避加抖动，被限速的 key 冷却，其他批次会换到别的 key
+                cooldown = min(60, 2 ** attempt) * (0.5 + random.random())
+                logging.warning('embedding batch %d failed on attempt %d: %s', batch_id, attempt, e)
+                self.keys.release(key, cooldown=cooldown if is_rate_limited(e) else 0)
+                if not is_rate_limited(e):
+                    time.sleep(cooldown)
+                continue
+            self.keys.release(key)
+            # 先写临时文件再改名，中断时不会留下不完整的批次
+            with open(batch_path + '.tmp', 'wb') as f:
+                np.save(f, vectors)
+            os.replace(batch_path + '.tmp', batch_path)
+            return vectors
+
+    def embed(self, name: str, texts: List[str]) -> np.ndarray:
+        path = self._checkpoint_dir(name, texts)
+        futures = [
+            self.executor.submit(self._embed_batch, path, batch_id,
+                                 texts[start:start + self.batch_size])
+            for batch_id, start in enumerate(range(0, len(texts), self.batch_size))
+        ]
+        vectors = np.vstack([future.result() for future in futures])
+        return vectors
+
+    def clear(self, name: str):
+        """索引写入成功后删除检查点"""
+        shutil.rmtree(os.path.join(self.checkpoint_path, f"{name}.build"), ignore_errors=True)
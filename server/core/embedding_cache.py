@@ -0,0 +1,127 @@
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+# 内存中缓存的查询向量条数
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 10000))
+# 持久化缓存的 sqlite 文件，为空则只用内存缓存
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', '')
+
+
+def normalize_query(text: str) -> str:
+    """全角转半角、合并空白，让写法略有不同的同一问题命中同一条缓存"""
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class SqliteEmbeddingStore:
+    """查询向量的本地持久化层"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """首次使用时才连接，多进程 fork 后按 pid 各自连接，sqlite 连接不能跨 fork 使用"""
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS embedding (key TEXT PRIMARY KEY, vector BLOB)')
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str):
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT vector FROM embedding WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO embedding (key, vector) VALUES (?, ?)',
+                (key, vector.astype(np.float32).tobytes()))
+            self.conn.commit()
+
+
+class EmbeddingCache:
+    """
+    查询向量缓存，放在 OpenAIEmbeddings 前面
+    - 按 (模型, 规范化后的查询) 索引
+    - 内存 LRU + 可选的 sqlite 持久化层
+    """
+
+    def __init__(self,
+                 embeddings,
+                 max_entries: int = EMBEDDING_CACHE_SIZE,
+                 path: str = EMBEDDING_CACHE_PATH):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, 'model', '')
+        self.max_entries = max_entries
+        self.disk = SqliteEmbeddingStore(path) if path else None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model}\n{text}".encode('utf-8')).hexdigest()
+
+    def embed_query(self, query: str) -> np.ndarray:
+        text = normalize_query(query)
+        key = self.key(text)
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return vector
+
+        vector = self.disk.get(key) if self.disk else None
+        if vector is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            vector = np.array(self.embeddings.embed_query(text), dtype=np.float32)
+            with self._lock:
+                self.misses += 1
+            if self.disk:
+                try:
+                    self.disk.put(key, vector)
+                except sqlite3.Error as e:
+                    logging.warning('embedding cache write failed: %s', e)
+
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return vector
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._cache),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0,
+            }
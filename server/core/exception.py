@@ -23,3 +23,21 @@ class PermissionDenied(InternalError):
 
 class ParametersError(InternalError):
     """参数错误"""
+
+
+class UpstreamError(InternalError):
+    """上游接口(OpenAI)调用失败"""
+
+    def __init__(self, msg='上游服务错误', code=-1, status=None, retry_after=None):
+        self.status = status
+        self.retry_after = retry_after
+        super().__init__(msg, code)
+
+
+class Overloaded(InternalError):
+    """服务过载，请求被拒绝，status 为返回的 HTTP 状态码"""
+
+    def __init__(self, msg='服务繁忙，请稍后重试', code=-1, status=503, retry_after=None):
+        self.status = status
+        self.retry_after = retry_after
+        super().__init__(msg, code)
@@ -0,0 +1,139 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+
+
+# 连接池大小及空闲长连接的保留时间
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 60))
+# 需要安装 h2 (pip install httpx[http2])
+HTTP2 = os.getenv('HTTP2', '0') == '1'
+HTTP_PROXY = os.getenv('HTTP_PROXY', '')
+# 各阶段超时秒数: 建连、两次读之间、从发出请求到收到响应头、等待连接池
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 60))
+HTTP_FIRST_BYTE_TIMEOUT = float(os.getenv('HTTP_FIRST_BYTE_TIMEOUT', 30))
+HTTP_POOL_TIMEOUT = float(os.getenv('HTTP_POOL_TIMEOUT', 10))
+
+
+class ConnectionStats:
+    """通过 httpcore 的 trace 扩展统计连接复用情况"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.handshake_time = 0.0
+        self.first_byte_time = 0.0
+        self.first_byte_timeouts = 0
+
+    def tracer(self):
+        """每个请求一个 trace 回调，记录建连和 TLS 握手耗时"""
+        started = {}
+
+        async def trace(event_name: str, info: dict):
+            if event_name in ('connection.connect_tcp.started', 'connection.start_tls.started'):
+                started[event_name] = time.perf_counter()
+            elif event_name == 'connection.connect_tcp.complete':
+                self.new_connections += 1
+                self.handshake_time += time.perf_counter() - started.pop(
+                    'connection.connect_tcp.started', time.perf_counter())
+            elif event_name == 'connection.start_tls.complete':
+                self.tls_handshakes += 1
+                self.handshake_time += time.perf_counter() - started.pop(
+                    'connection.start_tls.started', time.perf_counter())
+
+        return trace
+
+    def as_dict(self) -> dict:
+        reused = max(0, self.requests - self.new_connections)
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': reused,
+            'reuse_rate': reused / self.requests if self.requests else 0.0,
+            'tls_handshakes': self.tls_handshakes,
+            'avg_handshake_ms': 1000 * self.handshake_time / self.new_connections
+            if self.new_connections else 0.0,
+            'avg_first_byte_ms': 1000 * self.first_byte_time / self.requests
+            if self.requests else 0.0,
+            'first_byte_timeouts': self.first_byte_timeouts,
+        }
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def make_client(proxy: str = HTTP_PROXY) -> httpx.AsyncClient:
+    http2 = HTTP2 and http2_available()
+    if HTTP2 and not http2:
+        logging.warning('HTTP2=1 but h2 is not installed, falling back to HTTP/1.1')
+    return httpx.AsyncClient(
+        http2=http2,
+        proxies=proxy or None,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        timeout=httpx.Timeout(connect=HTTP_CONNECT_TIMEOUT,
+                              read=HTTP_READ_TIMEOUT,
+                              write=HTTP_READ_TIMEOUT,
+                              pool=HTTP_POOL_TIMEOUT),
+    )
+
+
+class HttpClient:
+    """
+    进程内共享的 httpx.AsyncClient，长连接复用，省掉每次请求的 TCP/TLS 握手
+    多进程 fork 后按 pid 各自创建，不共享 socket
+    """
+
+    def __init__(self, proxy: str = HTTP_PROXY):
+        self.proxy = proxy
+        self._client = None
+        self._pid = None
+        self.stats = ConnectionStats()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._pid != os.getpid():
+            self._client = make_client(self.proxy)
+            self._pid = os.getpid()
+        return self._client
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, first_byte_timeout: float = HTTP_FIRST_BYTE_TIMEOUT,
+                     **kwargs):
+        """流式请求，超过 first_byte_timeout 仍未收到响应头时抛出 httpx.ReadTimeout"""
+        request = self.client.build_request(method, url, **kwargs)
+        request.extensions['trace'] = self.stats.tracer()
+        self.stats.requests += 1
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.client.send(request, stream=True),
+                                              first_byte_timeout)
+        except asyncio.TimeoutError:
+            self.stats.first_byte_timeouts += 1
+            raise httpx.ReadTimeout(f"no response within {first_byte_timeout}s", request=request)
+        self.stats.first_byte_time += time.perf_counter() - start
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def aclose(self):
+        if self._client is not None and self._pid == os.getpid():
+            await self._client.aclose()
+        self._client = None
+
+
+http_client = HttpClient()
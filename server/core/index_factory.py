@@ -0,0 +1,180 @@
+import os
+import json
+import math
+import logging
+from typing import Dict
+
+import faiss
+import numpy as np
+
+
+# 默认索引类型，可被每本小说构建时传入的参数覆盖，例如
+# INDEX_SPEC='{"type": "hnsw", "M": 32, "ef_construction": 200, "ef_search": 64}'
+# quantizer 压缩向量: none / fp16 / sq8 / pq，rerank 为精排候选倍数(0 不精排)，例如
+# INDEX_SPEC='{"type": "flat", "quantizer": "pq", "pq_m": 96, "rerank": 4}'
+DEFAULT_INDEX_SPEC = json.loads(os.getenv('INDEX_SPEC', '{"type": "flat"}'))
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw')
+QUANTIZERS = ('none', 'fp16', 'sq8', 'pq')
+
+SQ_TYPES = {
+    'fp16': faiss.ScalarQuantizer.QT_fp16,
+    'sq8': faiss.ScalarQuantizer.QT_8bit,
+}
+
+
+def normalize_spec(spec: Dict = None) -> Dict:
+    spec = dict(spec or DEFAULT_INDEX_SPEC)
+    spec.setdefault('type', 'flat')
+    if spec['type'] not in INDEX_TYPES:
+        raise ValueError(f"unknown index type {spec['type']}, expected one of {INDEX_TYPES}")
+    spec.setdefault('quantizer', 'none')
+    if spec['quantizer'] not in QUANTIZERS:
+        raise ValueError(f"unknown quantizer {spec['quantizer']}, expected one of {QUANTIZERS}")
+    if spec['quantizer'] == 'pq':
+        spec.setdefault('pq_m', 0)  # 0 表示每 16 维一个子量化器
+        spec.setdefault('pq_nbits', 8)
+    spec.setdefault('rerank', 0)
+    if spec['type'] == 'ivf_flat':
+        spec.setdefault('nlist', 0)  # 0 表示按向量数自动选择
+        spec.setdefault('nprobe', 16)
+    elif spec['type'] == 'hnsw':
+        spec.setdefault('M', 32)
+        spec.setdefault('ef_construction', 200)
+        spec.setdefault('ef_search', 64)
+    return spec
+
+
+def build_index(vectors: np.ndarray, ids: np.ndarray, spec: Dict = None) -> faiss.Index:
+    """按 spec 构建带 id 的索引: flat(精确) / ivf_flat / hnsw"""
+    spec = normalize_spec(spec)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    n, d = vectors.shape
+    quantizer = spec['quantizer']
+    pq_m = spec.get('pq_m') or max(1, d // 16)
+    pq_nbits = spec.get('pq_nbits', 8)
+    if quantizer == 'pq' and d % pq_m:
+        raise ValueError(f"pq_m={pq_m} must divide dimension {d}")
+    if quantizer == 'pq' and n < 2 ** pq_nbits:
+        # PQ 每个子空间训练 2**pq_nbits 个中心，训练样本不能少于中心数
+        if spec['type'] == 'hnsw' or n < 2:
+            # HNSWPQ 不能指定 pq_nbits，改用 sq8
+            logging.warning('%d vectors are too few for %d-bit PQ, falling back to sq8', n, pq_nbits)
+            quantizer = 'sq8'
+        else:
+            logging.info('%d vectors are too few for %d-bit PQ, using %d bits',
+                         n, pq_nbits, int(math.log2(n)))
+            pq_nbits = int(math.log2(n))
+    if spec['type'] == 'flat':
+        if quantizer == 'none':
+            index = faiss.IndexFlatL2(d)
+        elif quantizer == 'pq':
+            index = faiss.IndexPQ(d, pq_m, pq_nbits)
+        else:
+            index = faiss.IndexScalarQuantizer(d, SQ_TYPES[quantizer])
+        index = faiss.IndexIDMap2(index)
+    elif spec['type'] == 'ivf_flat':
+        # 每个聚类至少 39 个训练样本，否则 faiss 聚类效果差
+        nlist = spec['nlist'] or int(4 * math.sqrt(n))
+        nlist = max(1, min(nlist, n // 39))
+        if quantizer == 'none':
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(d), d, nlist, faiss.METRIC_L2)
+        elif quantizer == 'pq':
+            index = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, pq_m, pq_nbits)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(faiss.IndexFlatL2(d), d, nlist,
+                                                  SQ_TYPES[quantizer], faiss.METRIC_L2)
+    else:
+        if quantizer == 'none':
+            hnsw = faiss.IndexHNSWFlat(d, spec['M'])
+        elif quantizer == 'pq':
+            hnsw = faiss.IndexHNSWPQ(d, pq_m, spec['M'])
+        else:
+            hnsw = faiss.IndexHNSWSQ(d, SQ_TYPES[quantizer], spec['M'])
+        hnsw.hnsw.efConstruction = spec['ef_construction']
+        index = faiss.IndexIDMap2(hnsw)
+    if not index.is_trained:
+        index.train(vectors)
+    if n:
+        index.add_with_ids(vectors, ids)
+    apply_search_params(index, spec)
+    return index
+
+
+def inner_index(index: faiss.Index) -> faiss.Index:
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def apply_search_params(index: faiss.Index, spec: Dict = None):
+    """设置检索时的参数，载入索引后调用"""
+    spec = normalize_spec(spec)
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = spec.get('nprobe', inner.nprobe)
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = spec.get('ef_search', inner.hnsw.efSearch)
+
+
+def supports_remove(index: faiss.Index) -> bool:
+    """HNSW 不支持按 id 删除，增量更新时需要重建"""
+    return not isinstance(inner_index(index), faiss.IndexHNSW)
+
+
+def is_quantized(spec: Dict) -> bool:
+    """压缩索引无法还原原始向量，需要另存原始向量用于精排和重建"""
+    return normalize_spec(spec)['quantizer'] != 'none'
+
+
+def search_index(index: faiss.Index, queries: np.ndarray, k: int,
+                 spec: Dict = None, vectors: np.ndarray = None, rows=None):
+    """
+    检索，返回 (L2 距离平方, id)
+    压缩索引且开启 rerank 时，先取 k * rerank 个候选，再用原始向量精确计算距离重排
+    vectors 为按行保存的原始向量，rows 把 id 映射到行号
+    """
+    spec = normalize_spec(spec)
+    if not spec['rerank'] or vectors is None:
+        return index.search(queries, k)
+    distances, ids = index.search(queries, k * spec['rerank'])
+    out_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    out_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for q, (query, candidates) in enumerate(zip(queries, ids)):
+        candidates = candidates[candidates >= 0]
+        # 只读取候选行，mmap 的向量文件不会整体载入内存；不在切片库中的 id 跳过
+        candidate_rows = []
+        found = []
+        for i in candidates:
+            try:
+                candidate_rows.append(rows(i))
+                found.append(i)
+            except KeyError:
+                continue
+        if not candidate_rows:
+            continue
+        candidates = np.array(found, dtype=np.int64)
+        exact = ((np.asarray(vectors[candidate_rows]) - query) ** 2).sum(axis=1)
+        order = np.argsort(exact)[:k]
+        out_distances[q, :len(order)] = exact[order]
+        out_ids[q, :len(order)] = candidates[order]
+    return out_distances, out_ids
+
+
+def reconstruct_vectors(index: faiss.Index, ids) -> np.ndarray:
+    """按 id 取回索引中保存的向量，压缩索引返回的是近似值"""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return np.zeros((0, index.d), dtype=np.float32)
+    if isinstance(index, faiss.IndexIDMap2):
+        return np.vstack([index.reconstruct(i) for i in ids])
+    if isinstance(index, faiss.IndexIVF):
+        # IVF 的 id 不连续，用哈希表做 id 到向量的映射
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    # 没有 id 映射的旧 Flat 索引，id 即行号
+    return np.vstack([index.reconstruct(i) for i in ids])
+
+
+def index_nbytes(index: faiss.Index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
@@ -0,0 +1,152 @@
+import os
+import time
+import asyncio
+import logging
+from typing import List, Set
+
+from core.exception import UpstreamError
+
+
+# 每个 key 每分钟的请求数和 token 数上限
+KEY_RPM = float(os.getenv('KEY_RPM', 3500))
+KEY_TPM = float(os.getenv('KEY_TPM', 90000))
+# 429 且没有 Retry-After 时的冷却秒数
+KEY_COOLDOWN = float(os.getenv('KEY_COOLDOWN', 20))
+# 401/403 的 key 隔离秒数
+KEY_QUARANTINE = float(os.getenv('KEY_QUARANTINE', 24 * 3600))
+
+
+class TokenBucket:
+    """每分钟补充 rate 个令牌，最多攒 rate 个"""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """还需等待多少秒才够 amount 个令牌，超过容量的按容量算"""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def consume(self, amount: float, now: float):
+        self._refill(now)
+        # 允许透支，之后的请求相应地多等
+        self.tokens -= amount
+
+
+class KeyState:
+
+    def __init__(self, key: str, rpm: float, tpm: float):
+        self.key = key
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.cooldown_until = 0.0
+        self.quarantined_until = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.rate_limited = 0
+        self.rejected = 0
+
+    def ready_in(self, tokens: float, now: float) -> float:
+        return max(self.requests.wait_time(1, now),
+                   self.tokens.wait_time(tokens, now),
+                   self.cooldown_until - now,
+                   self.quarantined_until - now)
+
+
+class KeyScheduler:
+    """
+    多个 API key 的调度，每个 key 一个每分钟请求数桶和 token 数桶
+    - 选出最快可用的 key，有余量时立即返回，不加任何等待
+    - 都没有余量时在锁外 sleep 到最早可用的时刻，再重新选择
+    - 429 的 key 冷却，401/403 的 key 隔离
+    """
+
+    def __init__(self,
+                 api_keys: List[str],
+                 rpm: float = KEY_RPM,
+                 tpm: float = KEY_TPM,
+                 cooldown: float = KEY_COOLDOWN,
+                 quarantine: float = KEY_QUARANTINE):
+        self.states = {key: KeyState(key, rpm, tpm) for key in api_keys}
+        self.cooldown = cooldown
+        self.quarantine = quarantine
+        self.waits = 0
+        self.wait_time = 0.0
+
+    async def acquire(self, tokens: int = 0, exclude: Set[str] = ()) -> str:
+        """
+        取一个 key，并按预计的 token 数扣减额度
+        exclude 中的 key 只在没有其他可用 key 时使用，重试和对冲请求借此换到别的 key
+        """
+        start = time.monotonic()
+        waited = False
+        while True:
+            now = time.monotonic()
+            usable = [state for state in self.states.values() if state.quarantined_until <= now]
+            if not usable:
+                raise UpstreamError('API key Exhausted')
+            usable = [state for state in usable if state.key not in exclude] or usable
+            # 同样可用时选进行中请求最少的，分散负载
+            state = min(usable, key=lambda s: (s.ready_in(tokens, now), s.in_flight))
+            delay = state.ready_in(tokens, now)
+            if delay <= 0:
+                # 选择和扣减之间没有 await，不需要锁
+                state.requests.consume(1, now)
+                state.tokens.consume(tokens, now)
+                state.in_flight += 1
+                state.calls += 1
+                if waited:
+                    self.waits += 1
+                    self.wait_time += now - start
+                return state.key
+            waited = True
+            await asyncio.sleep(delay)
+
+    def release(self, key: str, status: int = 200, retry_after: str = None, tokens: int = 0):
+        """
+        请求结束后调用
+        status 为上游返回的状态码，tokens 为请求结束后才知道的额外 token 数(如回复的 token 数)
+        """
+        state = self.states.get(key)
+        if state is None:
+            return
+        now = time.monotonic()
+        state.in_flight -= 1
+        if tokens:
+            state.tokens.consume(tokens, now)
+        if status == 429:
+            state.rate_limited += 1
+            try:
+                cooldown = float(retry_after)
+            except (TypeError, ValueError):
+                cooldown = self.cooldown
+            state.cooldown_until = max(state.cooldown_until, now + cooldown)
+            logging.warning('API key ...%s rate limited, cooling down %.1fs', key[-4:], cooldown)
+        elif status in (401, 403):
+            state.rejected += 1
+            state.quarantined_until = now + self.quarantine
+            logging.error('API key ...%s rejected with %d, quarantined', key[-4:], status)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'keys': [{
+                'key': '...' + state.key[-4:],
+                'in_flight': state.in_flight,
+                'calls': state.calls,
+                'rate_limited': state.rate_limited,
+                'rejected': state.rejected,
+                'cooling_down': state.cooldown_until > now,
+                'quarantined': state.quarantined_until > now,
+            } for state in self.states.values()],
+        }
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import logging
+from typing import Dict, List, Set
+
+from core.exception import UpstreamError
+from core.resilience import LatencyTracker
+
+
+# 每类调用按顺序排列的候选模型，排在前面的更快更便宜；context 为模型的上下文长度
+# chat 为交互式聊天，extract 为离线抽取/翻译等，例如
+# MODEL_ROUTES='{"chat": [{"model": "gpt-3.5-turbo", "context": 16385}], "extract": [...]}'
+DEFAULT_ROUTES = {
+    'chat': [
+        {'model': 'gpt-3.5-turbo-0613', 'context': 4096},
+        {'model': 'gpt-3.5-turbo-16k-0613', 'context': 16384},
+    ],
+    'extract': [
+        {'model': 'gpt-3.5-turbo-0613', 'context': 4096},
+        {'model': 'gpt-3.5-turbo-16k-0613', 'context': 16384},
+    ],
+}
+MODEL_ROUTES = json.loads(os.getenv('MODEL_ROUTES', '') or 'null') or DEFAULT_ROUTES
+# 没有指定回复长度时预留的 token 数，4096 - 1096 即原来 prompt 超过 3000 换 16k 模型的分界
+DEFAULT_COMPLETION_TOKENS = int(os.getenv('DEFAULT_COMPLETION_TOKENS', 1096))
+# 连续失败多少次后判定模型不可用，以及不可用的持续秒数
+MODEL_FAILURE_THRESHOLD = int(os.getenv('MODEL_FAILURE_THRESHOLD', 3))
+MODEL_COOLDOWN = float(os.getenv('MODEL_COOLDOWN', 30))
+
+# 算作模型故障的状态码，429/401/403 是 key 的问题，由 key 调度处理
+MODEL_FAILURE_STATUSES = (404, 500, 502, 503, 504)
+
+
+class ModelHealth:
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.degraded_until = 0.0
+        self.first_chunk = LatencyTracker()
+        self.total = LatencyTracker()
+
+    def healthy(self, now: float) -> bool:
+        return self.degraded_until <= now
+
+
+class ModelRouter:
+    """
+    按配置选择模型
+    - 按调用类型取候选列表，选第一个能放下 prompt + 回复预算且健康的模型
+    - 模型连续失败后暂时摘除，期间自动切到下一个候选，冷却后恢复
+    - 记录每次调用选中的模型和延迟，用于调整路由配置
+    """
+
+    def __init__(self, routes: Dict[str, List[Dict]] = None,
+                 failure_threshold: int = MODEL_FAILURE_THRESHOLD,
+                 cooldown: float = MODEL_COOLDOWN):
+        self.routes = routes or MODEL_ROUTES
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health = {}
+
+    def _health(self, model: str) -> ModelHealth:
+        if model not in self.health:
+            self.health[model] = ModelHealth()
+        return self.health[model]
+
+    def choose(self, endpoint: str, prompt_tokens: int, completion_tokens: int = None,
+               exclude: Set[str] = ()) -> str:
+        """exclude 为本次请求中已经失败过的模型"""
+        candidates = self.routes.get(endpoint) or self.routes['chat']
+        budget = completion_tokens or DEFAULT_COMPLETION_TOKENS
+        fitting = [c for c in candidates if prompt_tokens + budget <= c.get('context', 0)]
+        if not fitting:
+            # 都放不下时用上下文最长的，由上游截断或报错
+            fitting = [max(candidates, key=lambda c: c.get('context', 0))]
+        now = time.monotonic()
+        for candidate in fitting:
+            model = candidate['model']
+            if model not in exclude and self._health(model).healthy(now):
+                return model
+        # 没有健康的候选时，选最早恢复的
+        return min(fitting, key=lambda c: (c['model'] in exclude,
+                                           self._health(c['model']).degraded_until))['model']
+
+    def record(self, model: str, endpoint: str, status: int = 200, error: Exception = None,
+               first_chunk: float = None, total: float = None) -> bool:
+        """记录一次调用的结果，返回是否为模型故障"""
+        health = self._health(model)
+        health.calls += 1
+        if error is None:
+            failed = False
+        elif isinstance(error, UpstreamError) and error.status is not None:
+            failed = error.status in MODEL_FAILURE_STATUSES
+        else:
+            # 超时、连接中断
+            failed = True
+        if failed:
+            health.errors += 1
+            health.consecutive_failures += 1
+            if health.consecutive_failures >= self.failure_threshold:
+                health.degraded_until = time.monotonic() + self.cooldown
+                logging.warning('model %s degraded after %d failures', model,
+                                health.consecutive_failures)
+        elif error is None:
+            health.consecutive_failures = 0
+            if first_chunk is not None:
+                health.first_chunk.add(first_chunk)
+            if total is not None:
+                health.total.add(total)
+        logging.info('model route endpoint=%s model=%s status=%s first_chunk=%s total=%s',
+                     endpoint, model, status if error is None else repr(error),
+                     first_chunk and round(first_chunk, 3), total and round(total, 3))
+        return failed
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            model: {
+                'calls': health.calls,
+                'errors': health.errors,
+                'healthy': health.healthy(now),
+                'first_chunk_p50': health.first_chunk.percentile(50),
+                'first_chunk_p95': health.first_chunk.percentile(95),
+                'total_p50': health.total.percentile(50),
+                'total_p95': health.total.percentile(95),
+            } for model, health in self.health.items()
+        }
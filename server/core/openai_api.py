@@ -1,41 +1,22 @@
+import os
 import time
-import requests
-from queue import PriorityQueue as PQ
-import time
-import httpx
-import asyncio
 import re
-import json
 from core.utils import token_str
+from core.token_budget import Conversation
+from core.conversation_store import make_conversation_store
+from core.http_client import HttpClient, http_client
+from core.key_scheduler import KEY_RPM, KEY_TPM, KeyScheduler
+from core.resilience import ResilientStream
+from core.exception import UpstreamError
+from core.sse import DONE, iter_sse
+from core.model_router import ModelRouter
+from core.admission import mark_first_chunk
 
 
-def get_content(data_str):
-    try:
-        encoded_data = data_str.encode('utf-8')
-        encoded_data = encoded_data[6:]
-        data = json.loads(encoded_data)
-    except Exception as e:
-        return None
-    choices = data.get('choices')  # 获取"choices"的值
-    # 检查 "choices" 是否是一个列表，且列表是否非空
-    if isinstance(choices, list) and len(choices) > 0:
-        # 获取第一个 "choice" 的 "content" 值
-        content = choices[0].get('delta').get('content')
-        return content
-    else:
-        return None
-
-
-def truncate_text(text: str, max_token: int = 15000) -> str:
-    token_cost = token_str(text)
-    if token_cost > max_token:
-        while token_cost > max_token:
-            char_to_truncate = int((token_cost - max_token))
-            text = text[:-char_to_truncate]
-            token_cost = token_str(text)
-        text = text + "..."
-    else:
-        return text
+# OpenAI 兼容接口的地址，压测时可指向本地的 mock_openai.py
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
+# 请求在流末尾返回 usage，关闭后回退到本地计数(兼容不支持 stream_options 的接口)
+OPENAI_STREAM_USAGE = os.getenv('OPENAI_STREAM_USAGE', '1') == '1'
 
 
 content_pattern = re.compile(r'"content":"([^"]*)"')
@@ -56,119 +37,120 @@ class openAI:
         model_name: str = "gpt-3.5-turbo-0613",
         reply_count: int = 1,
         system_prompt="You are a smart AI assistant.",
-        lastAPICallTime=time.time() - 100,
-        apiTimeInterval: float = 20.0,
+        rpm: float = KEY_RPM,
+        tpm: float = KEY_TPM,
     ) -> None:
         self.model_name = model_name
         self.system_prompt = system_prompt
-        self.apiTimeInterval = apiTimeInterval
-        self.session = requests.Session()
-        self.api_keys = PQ()
-        self.trash_api_keys = PQ()
-        for key in api_keys:
-            self.api_keys.put((lastAPICallTime, key))
+        self.keys = KeyScheduler(api_keys, rpm=rpm, tpm=tpm)
+        self.resilience = ResilientStream()
+        self.router = ModelRouter()
         self.proxy = proxy
-        if self.proxy:
-            proxies = {
-                "http": self.proxy,
-                "https": self.proxy,
-            }
-            self.session.proxies = proxies
+        # 指定代理时单独建连接池，否则使用进程内共享的连接池
+        self.http = HttpClient(proxy) if proxy else http_client
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.top_p = top_p
         self.reply_count = reply_count
-        self.conversation = {}
+        self.conversation = make_conversation_store()
         if token_str(self.system_prompt) > 1000:
             raise Exception("System prompt is too long")
 
-    # async def init_lock(self):
-    #     self.lock = asyncio.Lock()
-
-    async def get_api_key(self):
-        async with self.lock:
-            while self.trash_api_keys.qsize() and self.api_keys.qsize():
-                trash_key = self.trash_api_keys.get_nowait()
-                api_key = self.api_keys.get_nowait()
-
-                if trash_key[1] == api_key[1]:
-                    self.api_keys.put_nowait(
-                        (time.time() + 24 * 3600, api_key[1]))
-                else:
-                    self.trash_api_keys.put_nowait(trash_key)
-                    self.api_keys.put_nowait(api_key)
-                    break
-
-            api_key = self.api_keys.get_nowait()
-            if api_key[0] > time.time():
-                print('API key exhausted')
-                raise Exception('API key Exhausted')
-
-            delay = await self._calculate_delay(api_key)
-            await asyncio.sleep(delay=delay)
-            self.api_keys.put_nowait((time.time(), api_key[1]))
-
-        return api_key[1]
-
-    async def _calculate_delay(self, apiKey):
-        elapsed_time = time.time() - apiKey[0]
-        if elapsed_time < self.apiTimeInterval:
-            return self.apiTimeInterval - elapsed_time
-        else:
-            return 0
-
     def add_to_conversation(self,
                             message: str,
                             role: str,
-                            convo_id: str = "default"):
+                            convo_id: str = "default",
+                            tokens: int = None):
         if (convo_id not in self.conversation):
             self.reset(convo_id)
-        self.conversation[convo_id].append({"role": role, "content": message})
+        conversation = self.conversation[convo_id]
+        conversation.append(role, message, tokens)
+        # 写回存储，sqlite 存储取出的是副本
+        self.conversation[convo_id] = conversation
 
     def __truncate_conversation(self, convo_id: str = "default"):
         """
         Truncate the conversation
         """
-        last_dialog = self.conversation[convo_id][-1]
-        query = str(last_dialog['content'])
-        query = truncate_text(query, self.max_tokens)
-        self.conversation[convo_id] = self.conversation[convo_id][:-1]
-        conversation_token_costs = sum(
-            [token_str(x["content"]) for x in self.conversation[convo_id]])
-        total_token_cost = conversation_token_costs + token_str(query)
-
-        while total_token_cost > self.max_tokens:
-            farthest_dialogue = self.conversation[convo_id].pop(1)
-            total_token_cost -= token_str(farthest_dialogue['content'])
-
-        last_dialog['content'] = query
-        self.conversation[convo_id].append(last_dialog)
+        conversation = self.conversation[convo_id]
+        conversation.truncate(self.max_tokens)
+        self.conversation[convo_id] = conversation
+        return conversation
 
     async def ask_stream(self,
                          prompt: str,
                          role: str = "user",
                          convo_id: str = "default",
+                         usage: dict = None,
                          **kwargs) -> str:
+        """
+        usage 不为 None 时，填入上游返回的 token 用量
+        endpoint 为调用类型(chat 交互聊天 / extract 离线抽取)
+        max_tokens 为回复的 token 上限，同时用于选择模型；stop 为停止序列
+        max_chars 为回复的字符数上限，达到后截断并关闭上游连接，不再为多余的 token 付费
+        """
         if convo_id not in self.conversation:
             self.reset(convo_id=convo_id)
         self.add_to_conversation(prompt, "user", convo_id=convo_id)
-        self.__truncate_conversation(convo_id=convo_id)
-        if self.token_cost(convo_id=convo_id) > 3000:
-            model_name = 'gpt-3.5-turbo-16k-0613'
-        else:
-            model_name = 'gpt-3.5-turbo-0613'
-        apiKey = await self.get_api_key()
-        async with httpx.AsyncClient() as client:
-            async with client.stream(
+        conversation = self.__truncate_conversation(convo_id=convo_id)
+        prompt_tokens = conversation.prompt_tokens()
+        endpoint = kwargs.get('endpoint', 'chat')
+        failed_models = set()
+
+        def start(used_keys):
+            # 每次尝试重新选择模型，模型故障后重试会换到下一个候选
+            model_name = self.router.choose(endpoint, prompt_tokens, kwargs.get('max_tokens'),
+                                            exclude=failed_models)
+            return self._stream_completion(conversation.messages, model_name, role,
+                                           prompt_tokens, used_keys, usage,
+                                           failed_models=failed_models, **kwargs)
+
+        max_chars = kwargs.get('max_chars')
+        length = 0
+        stream = self.resilience.stream(start)
+        try:
+            async for res in stream:
+                if max_chars is not None:
+                    res = res[:max_chars - length]
+                    length += len(res)
+                if kwargs.get('test', False):
+                    print(str(res), end='')
+                if res:
+                    # 只记录第一次，作为准入控制的延迟信号
+                    mark_first_chunk()
+                    yield res
+                if max_chars is not None and length >= max_chars:
+                    break
+        finally:
+            await stream.aclose()
+
+    async def _stream_completion(self, messages: list, model_name: str, role: str,
+                                 prompt_tokens: int, used_keys: set, usage: dict = None,
+                                 failed_models: set = None, **kwargs):
+        """一次上游流式调用，非 200 时抛出 UpstreamError 由 resilience 决定是否重试"""
+        # 调用方指定了 key 时不经过调度，也不归还
+        explicit_key = kwargs.get('api_key')
+        apiKey = explicit_key or await self.keys.acquire(prompt_tokens, exclude=used_keys)
+        used_keys.add(apiKey)
+        status = 200
+        retry_after = None
+        chunks = 0
+        completion_tokens = 0
+        started = time.monotonic()
+        first_chunk = None
+        error = None
+        completed = False
+        try:
+            async with self.http.stream(
                     method="POST",
-                    url="https://api.openai.com/v1/chat/completions",
+                    url=f"{OPENAI_API_BASE}/chat/completions",
                     headers={
                         "Authorization":
-                        f"Bearer {kwargs.get('api_key', apiKey)}"
+                        f"Bearer {apiKey}"
                     },
                     json={
                         "model": model_name,
-                        "messages": self.conversation[convo_id],
+                        "messages": messages,
                         # kwargs
                         "temperature": kwargs.get('temperature',
                                                   self.temperature),
@@ -176,19 +158,52 @@ class openAI:
                         "n": self.reply_count,
                         "user": role,
                         "stream": True,
+                        **({"max_tokens": kwargs['max_tokens']}
+                           if kwargs.get('max_tokens') else {}),
+                        **({"stop": kwargs['stop']} if kwargs.get('stop') else {}),
+                        **({"stream_options": {"include_usage": True}}
+                           if OPENAI_STREAM_USAGE else {}),
                     },
             ) as response:
+                status = response.status_code
+                retry_after = response.headers.get('retry-after')
                 if response.status_code != 200:
-                    if response.status_code == 403:  # API key error
-                        self.trash_api_keys.put((time.time(), apiKey))
-                    raise Exception(f"Error: {response.status_code}")
-                async for chunk in response.aiter_lines():
-                    if chunk:
-                        res = get_content(chunk)
+                    raise UpstreamError(f"Error: {response.status_code}",
+                                        status=status, retry_after=retry_after)
+                async for event in iter_sse(response.aiter_bytes()):
+                    # [DONE] 之后继续读到响应结束，读完 chunked 结尾的连接才能放回连接池复用
+                    if event.data == DONE:
+                        continue
+                    data = event.json()
+                    if data.get('error'):
+                        raise UpstreamError(f"Error: {data['error'].get('message', '')}", status=500)
+                    if data.get('usage'):
+                        completion_tokens = data['usage'].get('completion_tokens', chunks)
+                        if usage is not None:
+                            usage.update(data['usage'])
+                    choices = data.get('choices')
+                    if choices:
+                        res = (choices[0].get('delta') or {}).get('content')
                         if res:
-                            if kwargs.get('test', False):
-                                print(str(res), end='')
-                            yield str(res)
+                            if first_chunk is None:
+                                first_chunk = time.monotonic() - started
+                            chunks += 1
+                            yield res
+            completed = True
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 被取消(对冲落后、客户端断开)的调用不计入模型的成败
+            if completed or error is not None:
+                if self.router.record(model_name, kwargs.get('endpoint', 'chat'), status, error,
+                                      first_chunk, time.monotonic() - started) \
+                        and failed_models is not None:
+                    failed_models.add(model_name)
+            # 没有 usage 时按每个 chunk 约一个 token，计入该 key 的 token 额度
+            if not explicit_key:
+                self.keys.release(apiKey, status, retry_after=retry_after,
+                                  tokens=completion_tokens or chunks)
 
     from typing import Tuple
 
@@ -200,31 +215,38 @@ class openAI:
         """
         Non-streaming ask
         """
-        full_response = ''
+        usage = {}
+        responses = []
         async for response in self.ask_stream(prompt, role, convo_id,
-                                              **kwargs):
-            full_response += response
+                                              usage=usage, **kwargs):
+            responses.append(response)
+        full_response = ''.join(responses)
         # full_response = full_response.replace(r"\\\"", r"\\\\")
-        prompt_token = self.token_cost(convo_id=convo_id)
-        completion_token = token_str(full_response)
-        self.add_to_conversation(full_response, role, convo_id=convo_id)
+        # 优先使用上游返回的用量，不再本地重新计数
+        prompt_token = usage.get('prompt_tokens') or self.token_cost(convo_id=convo_id)
+        completion_token = usage.get('completion_tokens') or token_str(full_response)
+        self.add_to_conversation(full_response, role, convo_id=convo_id, tokens=completion_token)
         total_token = prompt_token + completion_token
         return full_response, prompt_token, completion_token, total_token
 
-    def reset(self, convo_id: str = "default", system_prompt=None):
+    def reset(self, convo_id: str = "default", system_prompt=None, system_tokens: int = None):
         """
         Reset the conversation
+        system_tokens 为已知的 system prompt token 数，传入时不再重新计数
         """
-        self.conversation[convo_id] = [
+        self.conversation[convo_id] = Conversation([
             {
                 "role": "system",
                 "content": str(system_prompt or self.system_prompt)
             },
-        ]
-        
+        ], [system_tokens] if system_tokens is not None else None)
+
+    def release(self, convo_id: str):
+        """一次性的对话用完后释放"""
+        self.conversation.release(convo_id)
+
     def token_cost(self, convo_id: str = "default"):
-        return token_str("\n".join(
-            [x["content"] for x in self.conversation[convo_id]]))
+        return self.conversation[convo_id].prompt_tokens()
 
 def main():
     return
@@ -3,7 +3,38 @@ import re
 from core.openai_api import openAI
 import re
 import asyncio
-from core.utils import token_str, is_english, get_uuid, check_language
+from core.utils import is_english, get_uuid, check_language
+from core.tokens import token_counter
+import os
+import json
+
+
+# 各方法默认的回复上限: max_tokens 为回复 token 数，stop 为停止序列
+# 可用 COMPLETION_LIMITS 环境变量(json)按方法名覆盖，例如
+# COMPLETION_LIMITS='{"generate_answer_by_search_results": {"max_tokens": 256}}'
+DEFAULT_COMPLETION_LIMITS = {
+    # 译文长度与原文相当，只防止失控
+    'translate_output': {'max_tokens': 4096},
+    # 只输出一句检索语句
+    'optimize_query': {'max_tokens': 128, 'stop': ['\n\n']},
+    'novel_chapter_extract': {'max_tokens': 1500},
+    'novel_chapter_extract_long': {'max_tokens': 1500},
+    'novel_character_extract_dialogue': {'max_tokens': 2000},
+    'novel_character_extract_thoughts': {'max_tokens': 2000},
+    # 角色回答，停在模型自己续写的下一轮用户问题之前
+    'generate_answer_by_search_results': {'max_tokens': 1024, 'stop': ['- 用户问题']},
+    'stream_answer_by_search_results': {'max_tokens': 1024, 'stop': ['- 用户问题']},
+}
+COMPLETION_LIMITS = {
+    method: {**limits, **json.loads(os.getenv('COMPLETION_LIMITS', '') or '{}').get(method, {})}
+    for method, limits in DEFAULT_COMPLETION_LIMITS.items()
+}
+
+
+def completion_limits(method: str, limits: dict) -> dict:
+    """方法的默认回复上限，调用方传入的值优先，值为 None 表示不限制"""
+    merged = {**COMPLETION_LIMITS.get(method, {}), **limits}
+    return {k: v for k, v in merged.items() if v is not None}
 
 
 
@@ -11,28 +42,16 @@ def clean_section_text(text: str) -> str:
     final_res = ''
     res_lines = text.split('\n')
     if len(res_lines) > 1:
-        for line in res_lines:
+        for line, line_tokens in zip(res_lines, token_counter.count_batch(res_lines)):
             if re.match(r"^\((.*)\)$", line, re.DOTALL):  # 清洗像(note: xxx)等无关内容
                 continue
-            if token_str(line) > 50:  # 清洗太短的行,提取出主要部分
+            if line_tokens > 50:  # 清洗太短的行,提取出主要部分
                 final_res += line + '\n'
     else:
         final_res = text
     return str(final_res)
 
 
-def truncate_text(text: str, max_token: int = 15000) -> str:
-    token_cost = token_str(text)
-    if token_cost > max_token:
-        while token_cost > max_token:
-            char_to_truncate = int((token_cost - max_token))
-            text = text[:-char_to_truncate]
-            token_cost = token_str(text)
-        text = text + "..."
-    else:
-        return text
-
-
 class OpenAI:
 
     def __init__(
@@ -45,15 +64,14 @@ class OpenAI:
         self.openAIAPI = openAI(api_keys=api_keys,
                                 model_name=model_name,
                                 top_p=p,
-                                temperature=temperature,
-                                apiTimeInterval=0.1)
+                                temperature=temperature)
 
     def print_token(self, result):
         print("Prompt used: ", str(result[1]) + " tokens.")
         print("Completion used: ", str(result[2]) + " tokens.")
         print("Totally used: ", str(result[3]) + " tokens.")
 
-    async def translate_output(self, semaphore, text: str, language: str):
+    async def translate_output(self, semaphore, text: str, language: str, **limits):
         async with semaphore:
             print(f"translate {language}")
             convo_id = "translate" + str(get_uuid())
@@ -63,10 +81,14 @@ class OpenAI:
             {text}
             将上面文本翻译为{language}。请注意，原文中的所有学术词汇和缩写应保留为英文，其余部分请使用{language}进行翻译。除翻译内容外，不需要输出任何其他信息, 保留原来的文本格式。
             """
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id)
-            self.openAIAPI.conversation[convo_id] = None
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  endpoint="extract",
+                                                  **completion_limits('translate_output', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
             res = str(result[0])
             print('translate done')
             # 断言输出语言是否符合预期
@@ -79,15 +101,19 @@ class OpenAI:
             semaphore,
             query: str,
             language: str = 'English',
+            **limits,
     ):
         async with semaphore:
             convo_id = "summary" + str(get_uuid())
             self.openAIAPI.reset(convo_id=convo_id, system_prompt=f"")
             content = f"Translate the user's question into {language}, and then rephrase it into an exact, standardized query specifically designed for vector database search. Focus on retaining the essential elements and core concepts of the original question. The restructured query must be formulated to maximize the probability of a precise match in a vectorized text database. Output only the final and most accurately optimized query:{query}"
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id)
-            self.openAIAPI.conversation[convo_id] = None
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  **completion_limits('optimize_query', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
 
             return str(result[0])
 
@@ -96,6 +122,7 @@ class OpenAI:
             semaphore,
             title: str,
             text: str,
+            **limits,
     ):
         async with semaphore:
             convo_id = "summary" + str(get_uuid())
@@ -144,10 +171,14 @@ class OpenAI:
 {text}
 开始提炼:
             """
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id)
-            self.openAIAPI.conversation[convo_id] = None
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  endpoint="extract",
+                                                  **completion_limits('novel_chapter_extract', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
             return str(result[0])
 
     async def novel_chapter_extract_long(
@@ -156,6 +187,7 @@ class OpenAI:
             title: str,
             text: str,
             summary_before: str,
+            **limits,
     ):
         async with semaphore:
             convo_id = "summary" + str(get_uuid())
@@ -210,10 +242,14 @@ class OpenAI:
 
 开始提炼:
             """
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id)
-            self.openAIAPI.conversation[convo_id] = None
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  endpoint="extract",
+                                                  **completion_limits('novel_chapter_extract_long', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
             return str(result[0])
 
     async def novel_character_extract_dialogue(
@@ -223,6 +259,7 @@ class OpenAI:
             text: str,
             character: str,
             summary_before: str = '',
+            **limits,
     ):
         async with semaphore:
             convo_id = "summary" + str(get_uuid())
@@ -261,10 +298,14 @@ class OpenAI:
 
 **现在，请开始提炼**：
             """
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id)
-            self.openAIAPI.conversation[convo_id] = None
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  endpoint="extract",
+                                                  **completion_limits('novel_character_extract_dialogue', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
             return str(result[0])
 
     #     async def novel_character_extract_thoughts(
@@ -355,6 +396,7 @@ class OpenAI:
             semaphore,
             title: str,
             text: str,
+            **limits,
     ):
         async with semaphore:
             character = '叶文洁'
@@ -387,30 +429,32 @@ class OpenAI:
 
 """
 
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id)
-            self.openAIAPI.conversation[convo_id] = None
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  endpoint="extract",
+                                                  **completion_limits('novel_character_extract_thoughts', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
             return str(result[0])
 
-    async def generate_answer_by_search_results(
-            self,
-            semaphore,
-            text: str,
-            query: str,
-            book_name: str,
-            character_name: str,
-            character_description: str,
-    ):
-        async with semaphore:
-            convo_id = "summary" + str(get_uuid())
-            self.openAIAPI.reset(convo_id=convo_id, system_prompt=f"""
+    @staticmethod
+    def answer_system_prompt(book_name: str, character_name: str, character_description: str):
+        """角色扮演回答的 system prompt，只与角色有关，可以预先生成"""
+        return f"""
 I want you to act like {character_name} from {book_name}.
 Answer in user's language as concisely as possible.
 The following is information about {character_name}, please follow the instructions below to extract and expand only the description of the role
- {character_description}""")
-
-            content = f"""
+ {character_description}"""
+
+    @staticmethod
+    def answer_prompt(text: str, query: str, book_name: str, character_name: str,
+                      character_description: str, persona=None):
+        """角色扮演回答的 (system prompt, 用户消息)，persona 为 core.persona 中缓存的人设"""
+        system_prompt = persona.system_prompt if persona else \
+            OpenAI.answer_system_prompt(book_name, character_name, character_description)
+        content = f"""
 - {book_name} 中的相关情节：{text}
 - 用户问题：{query}
 You are now cosplay {character_name} to answer the user's question.
@@ -419,27 +463,82 @@ I want you to respond and answer like {character_name} using the tone, manner an
 You must know all of the knowledge of {character_name}.
 Never say you are playing {character_name} , you just know the answer because you are {character_name}.
 """
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id,
-                                              test=True)
-            self.openAIAPI.conversation[convo_id] = None
+        return system_prompt, content
+
+    async def generate_answer_by_search_results(
+            self,
+            semaphore,
+            text: str,
+            query: str,
+            book_name: str,
+            character_name: str,
+            character_description: str,
+            persona=None,
+            **limits,
+    ):
+        async with semaphore:
+            convo_id = "summary" + str(get_uuid())
+            system_prompt, content = self.answer_prompt(text, query, book_name, character_name,
+                                                        character_description, persona)
+            # 有预先生成的人设时直接使用其 system prompt 的 token 数，不再重新计数
+            self.openAIAPI.reset(convo_id=convo_id, system_prompt=system_prompt,
+                                 system_tokens=persona and persona.system_tokens)
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  test=True,
+                                                  **completion_limits('generate_answer_by_search_results', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
             res = str(result[0])
             return res
 
+    async def stream_answer_by_search_results(
+            self,
+            semaphore,
+            text: str,
+            query: str,
+            book_name: str,
+            character_name: str,
+            character_description: str,
+            persona=None,
+            **limits,
+    ):
+        """与 generate_answer_by_search_results 相同，逐段返回回复"""
+        async with semaphore:
+            convo_id = "summary" + str(get_uuid())
+            system_prompt, content = self.answer_prompt(text, query, book_name, character_name,
+                                                        character_description, persona)
+            # 有预先生成的人设时直接使用其 system prompt 的 token 数，不再重新计数
+            self.openAIAPI.reset(convo_id=convo_id, system_prompt=system_prompt,
+                                 system_tokens=persona and persona.system_tokens)
+            try:
+                async for delta in self.openAIAPI.ask_stream(prompt=content,
+                                                             role="user",
+                                                             convo_id=convo_id,
+                                                             **completion_limits('stream_answer_by_search_results', limits)):
+                    yield delta
+            finally:
+                self.openAIAPI.release(convo_id)
+
     async def optimize_query(
             self,
             semaphore,
             query: str,
             language: str = 'English',
+            **limits,
     ):
         async with semaphore:
             convo_id = "summary" + str(get_uuid())
             self.openAIAPI.reset(convo_id=convo_id, system_prompt=f"")
             content = f"Translate the user's question into {language}, and then rephrase it into an exact, standardized query specifically designed for vector database search. Focus on retaining the essential elements and core concepts of the original question. The restructured query must be formulated to maximize the probability of a precise match in a vectorized text database. Output only the final and most accurately optimized query:{query}"
-            result = await self.openAIAPI.ask(prompt=content,
-                                              role="user",
-                                              convo_id=convo_id)
-            self.openAIAPI.conversation[convo_id] = None
+            try:
+                result = await self.openAIAPI.ask(prompt=content,
+                                                  role="user",
+                                                  convo_id=convo_id,
+                                                  **completion_limits('optimize_query', limits))
+            finally:
+                self.openAIAPI.release(convo_id)
 
             return str(result[0])
@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Tuple
+
+import aiofiles
+import aiofiles.os
+
+from core.tokens import token_counter
+from core.openai_prompt import OpenAI
+
+
+# 两次检查人设文件修改时间的最小间隔秒数，间隔内直接使用缓存，不做任何文件 I/O
+PERSONA_CHECK_INTERVAL = float(os.getenv('PERSONA_CHECK_INTERVAL', 5))
+
+
+class Persona:
+    """角色的描述及预先生成的 system prompt"""
+    __slots__ = ('path', 'mtime', 'checked', 'description', 'system_prompt', 'system_tokens')
+
+    def __init__(self, path: str, mtime: float, description: str, system_prompt: str):
+        self.path = path
+        self.mtime = mtime
+        self.checked = time.monotonic()
+        self.description = description
+        self.system_prompt = system_prompt
+        self.system_tokens = token_counter.count(system_prompt)
+
+
+class PersonaCache:
+    """
+    按 (描述文件, 书名, 角色名) 缓存人设
+    - 首次使用时用 aiofiles 异步读取描述文件，并生成 system prompt 及其 token 数
+    - 每隔 check_interval 秒检查一次文件修改时间，变化后重新载入
+    - 同一角色并发的首次请求只读取一次文件
+    """
+
+    def __init__(self, check_interval: float = PERSONA_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.personas: Dict[Tuple[str, str, str], Persona] = {}
+        self.loading: Dict[Tuple[str, str, str], asyncio.Future] = {}
+        self.hits = 0
+        self.loads = 0
+
+    async def get(self, path: str, book_name: str, character_name: str) -> Persona:
+        key = (path, book_name, character_name)
+        while True:
+            persona = self.personas.get(key)
+            if persona is not None and time.monotonic() - persona.checked < self.check_interval:
+                self.hits += 1
+                return persona
+            future = self.loading.get(key)
+            if future is None:
+                return await self._load(key, persona)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 负责载入的请求被取消时共享的 future 也会取消，其余等待者重新载入
+                if not future.cancelled():
+                    raise
+
+    async def _load(self, key: Tuple[str, str, str], persona: Persona = None) -> Persona:
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            persona = await self._refresh(key, persona)
+            future.set_result(persona)
+            return persona
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            self.loading.pop(key, None)
+
+    async def _refresh(self, key: Tuple[str, str, str], persona: Persona = None) -> Persona:
+        path, book_name, character_name = key
+        mtime = (await aiofiles.os.stat(path)).st_mtime
+        if persona is not None and persona.mtime == mtime:
+            self.hits += 1
+            persona.checked = time.monotonic()
+            return persona
+        async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+            description = await f.read()
+        self.loads += 1
+        if persona is not None:
+            logging.info('persona %s reloaded from %s', character_name, path)
+        persona = Persona(path, mtime, description,
+                          OpenAI.answer_system_prompt(book_name, character_name, description))
+        self.personas[key] = persona
+        return persona
+
+    def stats(self) -> dict:
+        return {
+            'personas': len(self.personas),
+            'hits': self.hits,
+            'loads': self.loads,
+        }
+
+
+personas = PersonaCache()
@@ -0,0 +1,165 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Callable, Set
+
+import httpx
+import numpy as np
+
+from core.exception import UpstreamError
+
+
+# 首个 token 之前失败时的最大重试次数
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 3))
+# 指数退避的基数和上限秒数，实际等待在 [0, 退避时间] 之间随机
+UPSTREAM_BACKOFF_BASE = float(os.getenv('UPSTREAM_BACKOFF_BASE', 0.5))
+UPSTREAM_BACKOFF_MAX = float(os.getenv('UPSTREAM_BACKOFF_MAX', 20))
+# 对冲请求: 超过首 token 延迟的 HEDGE_PERCENTILE 分位仍无响应时，换一个 key 再发一次
+HEDGE = os.getenv('HEDGE', '0') == '1'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+# 样本不足时使用默认等待秒数，且等待不低于最小值
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 3))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.5))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+
+# 可以换 key 重试的状态码
+# 404 通常是模型不存在，重试时由路由换到其他模型
+RETRY_STATUSES = (401, 403, 404, 408, 409, 429, 500, 502, 503, 504)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, UpstreamError):
+        return e.status in RETRY_STATUSES
+    # 建连失败、超时、连接中断
+    return isinstance(e, httpx.TransportError)
+
+
+def backoff_delay(attempt: int, retry_after=None) -> float:
+    """有 Retry-After 时按它等待，否则为带抖动的指数退避"""
+    try:
+        return min(float(retry_after), UPSTREAM_BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+
+class LatencyTracker:
+    """最近一段时间的首 token 延迟"""
+
+    def __init__(self, size: int = 500):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        return float(np.percentile(self.samples, p)) if self.samples else 0.0
+
+
+class ResilientStream:
+    """
+    流式调用的重试与对冲
+    - start(used_keys) 返回一次上游调用的异步迭代器，调用方把用到的 key 加入 used_keys
+    - 首个 chunk 之前失败且可重试时，退避后换 key 重试；已经输出内容后不再重试
+    - 开启对冲时，首个 chunk 迟迟不到就换 key 再发一次，用先出结果的那个
+    """
+
+    def __init__(self,
+                 max_retries: int = UPSTREAM_MAX_RETRIES,
+                 hedge: bool = HEDGE,
+                 hedge_percentile: float = HEDGE_PERCENTILE):
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.first_chunk_latency = LatencyTracker()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self) -> float:
+        if len(self.first_chunk_latency.samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, self.first_chunk_latency.percentile(self.hedge_percentile))
+
+    async def stream(self, start: Callable[[Set[str]], AsyncIterator[str]]) -> AsyncIterator[str]:
+        self.calls += 1
+        used_keys = set()
+        for attempt in range(self.max_retries + 1):
+            try:
+                stream, first = await self._first_chunk(start, used_keys)
+                break
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    self.failures += 1
+                    if isinstance(e, httpx.HTTPError):
+                        raise UpstreamError(f"upstream request failed: {e!r}") from e
+                    raise
+                delay = backoff_delay(attempt, getattr(e, 'retry_after', None))
+                self.retries += 1
+                logging.warning('upstream attempt %d failed (%r), retrying in %.2fs', attempt, e, delay)
+                await asyncio.sleep(delay)
+        if first is None:
+            return
+        try:
+            yield first
+            async for chunk in stream:
+                yield chunk
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise UpstreamError(f"upstream stream interrupted: {e!r}") from e
+        finally:
+            await stream.aclose()
+
+    async def _first_chunk(self, start, used_keys: Set[str]):
+        """返回 (先收到首个 chunk 的迭代器, 首个 chunk)，空回复时首个 chunk 为 None"""
+        started = time.monotonic()
+        primary = start(used_keys)
+        pending = {asyncio.ensure_future(anext(primary)): primary}
+        hedge = None
+        if self.hedge:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_delay())
+            if not done:
+                self.hedged += 1
+                hedge = start(used_keys)
+                pending[asyncio.ensure_future(anext(hedge))] = hedge
+        error = None
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                stream = pending.pop(task)
+                e = task.exception()
+                if e is None or isinstance(e, StopAsyncIteration):
+                    await self._cancel(pending)
+                    if stream is hedge:
+                        self.hedge_wins += 1
+                    self.first_chunk_latency.add(time.monotonic() - started)
+                    return stream, None if e else task.result()
+                error = e
+                await stream.aclose()
+        raise error
+
+    @staticmethod
+    async def _cancel(pending: dict):
+        """取消落后的请求，关闭迭代器以释放连接和 key"""
+        for task, stream in pending.items():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await stream.aclose()
+        pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+            'hedged': self.hedged,
+            # 对冲请求先出首个 chunk 的次数，即对冲挽回的慢请求数
+            'hedge_wins': self.hedge_wins,
+            'hedge_delay': self.hedge_delay(),
+            f'first_chunk_p{self.hedge_percentile:g}': self.first_chunk_latency.percentile(
+                self.hedge_percentile),
+        }
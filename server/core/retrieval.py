@@ -0,0 +1,90 @@
+import os
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from core.vector_store import vector_stores
+
+
+# 检索专用线程池大小，载入索引、embedding 查询和 faiss 检索都在这里执行
+RETRIEVAL_WORKERS = int(os.getenv('RETRIEVAL_WORKERS', 4))
+# 同一本小说的并发查询在这个时间窗口内合并成一次 faiss 检索
+RETRIEVAL_BATCH_WINDOW_MS = float(os.getenv('RETRIEVAL_BATCH_WINDOW_MS', 5))
+RETRIEVAL_MAX_BATCH = int(os.getenv('RETRIEVAL_MAX_BATCH', 32))
+
+
+class RetrievalService:
+    """
+    异步检索服务，不阻塞 IOLoop
+    - 阻塞的载入、embedding、检索都放到独立线程池
+    - 同一本小说的并发查询在短时间窗口内攒批，一次 index.search 后再分发结果
+    """
+
+    def __init__(self,
+                 embedder,
+                 workers: int = RETRIEVAL_WORKERS,
+                 batch_window_ms: float = RETRIEVAL_BATCH_WINDOW_MS,
+                 max_batch: int = RETRIEVAL_MAX_BATCH):
+        self.embedder = embedder
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='retrieval')
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self._pending = {}
+        self.searches = 0
+        self.queries = 0
+
+    async def run(self, func, *args):
+        """在检索线程池中执行阻塞函数，带上当前 context，请求内的 token 统计不丢失"""
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run,
+                                                                func, *args)
+
+    async def search(self, name: str, query: str, k: int):
+        """返回 (已载入的向量库, 距离, 向量 id)"""
+        loaded = await self.run(vector_stores.get, name)
+        vector = await self.run(self.embedder.embed_query, query)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # 向量库重新载入后的查询不与旧库的查询合并
+        key = (name, id(loaded))
+        batch = self._pending.setdefault(key, [])
+        batch.append((vector, k, future, loaded))
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif len(batch) == 1:
+            loop.call_later(self.batch_window, self._flush, key)
+        distances, ids = await future
+        return loaded, distances, ids
+
+    def _flush(self, key):
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        loaded = batch[0][3]
+        k = max(item[1] for item in batch)
+        queries = np.vstack([item[0] for item in batch]).astype(np.float32)
+        self.searches += 1
+        self.queries += len(batch)
+        task = asyncio.get_running_loop().run_in_executor(self.executor, loaded.search, queries, k)
+
+        def dispatch(task):
+            error = task.exception()
+            for i, (_, item_k, future, _) in enumerate(batch):
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    distances, ids = task.result()
+                    future.set_result((distances[i:i + 1, :item_k], ids[i:i + 1, :item_k]))
+
+        task.add_done_callback(dispatch)
+
+    def stats(self) -> dict:
+        return {
+            'searches': self.searches,
+            'queries': self.queries,
+            'avg_batch': self.queries / self.searches if self.searches else 0.0,
+        }
@@ -0,0 +1,76 @@
+import json
+from typing import AsyncIterator, Optional
+
+try:
+    # orjson 直接解析 bytes，比 json.loads 快数倍
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+DONE = b'[DONE]'
+
+
+class SSEEvent:
+    __slots__ = ('event', 'data', 'id')
+
+    def __init__(self, event: Optional[bytes], data: bytes, id: Optional[bytes]):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def json(self):
+        return loads(self.data)
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data!r})"
+
+
+async def iter_sse(chunks: AsyncIterator[bytes]) -> AsyncIterator[SSEEvent]:
+    """
+    增量解析 Server-Sent Events 字节流
+    - 直接在 bytes 上按行切分，不先解码成字符串
+    - 同一事件的多行 data 以换行拼接，空行结束一个事件，冒号开头的注释行忽略
+    """
+    buffer = b''
+    event = None
+    event_id = None
+    data = []
+    async for chunk in chunks:
+        buffer = buffer + chunk if buffer else chunk
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            start = end + 1
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line:
+                if data:
+                    yield SSEEvent(event, b'\n'.join(data), event_id)
+                event = None
+                data = []
+                continue
+            if line[:1] == b':':
+                continue
+            field, _, value = line.partition(b':')
+            if value[:1] == b' ':
+                value = value[1:]
+            if field == b'data':
+                data.append(value)
+            elif field == b'event':
+                event = value
+            elif field == b'id':
+                event_id = value
+        buffer = buffer[start:]
+    if data:
+        yield SSEEvent(event, b'\n'.join(data), event_id)
+
+
+def format_event(data, event: str = None) -> str:
+    """Server-Sent Events 格式的一条消息"""
+    message = f"event: {event}\n" if event else ''
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,81 @@
+import sys
+from typing import Dict, List, Tuple
+
+from core.tokens import token_counter
+
+
+# 按 OpenAI 的计数方式，每条消息额外占用的 token，以及回复开头固定占用的 token
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+def truncate_tokens(text: str, max_token: int, suffix: str = '...') -> Tuple[str, int]:
+    """
+    按 token 截断，返回 (截断后的文本, token 数)
+    只编码一次，截取前 max_token 个 token 再解码，截断处不完整的字符丢弃
+    """
+    tokens = token_counter.encode(text)
+    if len(tokens) <= max_token:
+        return text, len(tokens)
+    text = token_counter.encoder.decode_bytes(tokens[:max_token]).decode('utf-8', errors='ignore')
+    return text + suffix, token_counter.count(text + suffix, cache=False)
+
+
+class Conversation:
+    """
+    对话消息列表，记录每条消息的 token 数和总数
+    裁剪历史时直接使用记录的 token 数，不重新编码
+    """
+
+    def __init__(self, messages: List[Dict] = None, token_counts: List[int] = None):
+        self.messages = []
+        self.token_counts = []
+        self.total_tokens = 0
+        for i, message in enumerate(messages or []):
+            self.append(message['role'], message['content'],
+                        token_counts[i] if token_counts else None)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def append(self, role: str, content: str, tokens: int = None):
+        if tokens is None:
+            tokens = token_counter.count(content)
+        self.messages.append({"role": role, "content": content})
+        self.token_counts.append(tokens)
+        self.total_tokens += tokens
+
+    def pop(self, index: int = -1) -> Dict:
+        self.total_tokens -= self.token_counts.pop(index)
+        return self.messages.pop(index)
+
+    def truncate(self, max_tokens: int):
+        """
+        最后一条消息截断到 max_tokens，再从最早的一轮(系统提示词之后)开始丢弃历史，
+        直到总 token 数不超过 max_tokens
+        """
+        last = self.pop()
+        content, tokens = truncate_tokens(last['content'], max_tokens)
+        while len(self) > 1 and self.total_tokens + tokens > max_tokens:
+            self.pop(1)
+        self.append(last['role'], content, tokens)
+
+    def prompt_tokens(self) -> int:
+        """发送全部消息时的 prompt token 数"""
+        return self.total_tokens + TOKENS_PER_MESSAGE * len(self) + TOKENS_PER_REPLY
+
+    def nbytes(self) -> int:
+        """大致的内存占用"""
+        return sum(sys.getsizeof(message) + sys.getsizeof(message['content'])
+                   for message in self.messages)
+
+    def to_dict(self) -> Dict:
+        return {'messages': self.messages, 'token_counts': self.token_counts}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Conversation':
+        """连同 token 数一起恢复，不重新编码"""
+        return cls(data['messages'], data.get('token_counts'))
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict
+from typing import List
+
+import tiktoken
+
+
+TOKEN_ENCODING = os.getenv('TOKEN_ENCODING', 'cl100k_base')
+# 缓存的 token 数条数，按内容哈希做键，LRU 淘汰
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 8192))
+# 短文本直接编码，比计算哈希再查缓存更快
+TOKEN_CACHE_MIN_CHARS = int(os.getenv('TOKEN_CACHE_MIN_CHARS', 64))
+# encode_batch 使用的线程数
+TOKEN_BATCH_THREADS = int(os.getenv('TOKEN_BATCH_THREADS', 8))
+
+# 进程内唯一的编码器
+ENCODER = tiktoken.get_encoding(TOKEN_ENCODING)
+
+
+class TokenStats:
+    """token 计数的统计: 调用次数、缓存命中次数、实际编码的文本条数和字符数"""
+
+    __slots__ = ('calls', 'hits', 'encoded', 'encoded_chars')
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.encoded = 0
+        self.encoded_chars = 0
+
+    def as_dict(self) -> dict:
+        return {
+            'calls': self.calls,
+            'hits': self.hits,
+            'encoded': self.encoded,
+            'encoded_chars': self.encoded_chars,
+            'hit_rate': self.hits / self.calls if self.calls else 0.0,
+        }
+
+    def __repr__(self):
+        return f"TokenStats({self.as_dict()})"
+
+
+# 当前请求的统计，由 track_request 设置
+_request_stats = contextvars.ContextVar('token_stats', default=None)
+
+
+class TokenCounter:
+    """
+    带缓存的 token 计数
+    - 系统提示词、人设、章节摘要、历史对话等重复出现的文本只编码一次
+    - count_batch 用 tiktoken 的多线程 encode_batch 编码未命中的文本
+    - 进程累计和每个请求的计数，可以看出缓存省下了多少次编码
+    """
+
+    def __init__(self,
+                 encoder=ENCODER,
+                 max_entries: int = TOKEN_CACHE_SIZE,
+                 min_chars: int = TOKEN_CACHE_MIN_CHARS,
+                 threads: int = TOKEN_BATCH_THREADS):
+        self.encoder = encoder
+        self.max_entries = max_entries
+        self.min_chars = min_chars
+        self.threads = threads
+        self.total = TokenStats()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _record(self, calls: int, hits: int, encoded: int, encoded_chars: int):
+        request = _request_stats.get()
+        with self._lock:
+            for stats in (self.total, request):
+                if stats is None:
+                    continue
+                stats.calls += calls
+                stats.hits += hits
+                stats.encoded += encoded
+                stats.encoded_chars += encoded_chars
+
+    def _lookup(self, key: bytes):
+        with self._lock:
+            count = self._cache.get(key)
+            if count is not None:
+                self._cache.move_to_end(key)
+            return count
+
+    def _store(self, key: bytes, count: int):
+        with self._lock:
+            self._cache[key] = count
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def encode(self, text: str) -> List[int]:
+        self._record(1, 0, 1, len(text))
+        return self.encoder.encode(text)
+
+    def count(self, text: str, cache: bool = True) -> int:
+        """
+        文本的 token 数
+        只出现一次的文本(如切片时逐段校验的候选切片)传 cache=False，避免挤掉有用的缓存
+        """
+        if not cache or len(text) < self.min_chars:
+            return len(self.encode(text))
+        key = self._key(text)
+        count = self._lookup(key)
+        if count is not None:
+            self._record(1, 1, 0, 0)
+            return count
+        count = len(self.encode(text))
+        self._store(key, count)
+        return count
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        """批量计数，未命中缓存的文本一次性多线程编码"""
+        counts = [None] * len(texts)
+        keys = {}
+        misses = []
+        for i, text in enumerate(texts):
+            if len(text) >= self.min_chars:
+                keys[i] = self._key(text)
+                counts[i] = self._lookup(keys[i])
+            if counts[i] is None:
+                misses.append(i)
+        if misses:
+            encoded = self.encoder.encode_batch([texts[i] for i in misses],
+                                                num_threads=self.threads)
+            for i, tokens in zip(misses, encoded):
+                counts[i] = len(tokens)
+                if i in keys:
+                    self._store(keys[i], counts[i])
+        self._record(len(texts), len(texts) - len(misses), len(misses),
+                     sum(len(texts[i]) for i in misses))
+        return counts
+
+    def track_request(self) -> TokenStats:
+        """开始统计当前请求(当前 context)的 token 计数"""
+        stats = TokenStats()
+        _request_stats.set(stats)
+        return stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.total.as_dict(), entries=len(self._cache))
+
+
+token_counter = TokenCounter()
@@ -1,4 +1,5 @@
 import json
+import math
 import logging
 import functools
 from copy import deepcopy
@@ -11,7 +12,8 @@ from core.schema import Base, bson
 from inspect import getfullargspec, iscoroutinefunction
 from tornado.gen import is_coroutine_function
 from itertools import zip_longest
-from core.exception import ParametersError, NotFound, InternalError, Duplicate, PermissionDenied
+from core.exception import ParametersError, NotFound, InternalError, Duplicate, PermissionDenied, Overloaded
+from core.tokens import ENCODER, token_counter
 from tornado.web import Finish
 
 
@@ -59,6 +61,8 @@ def arguments(method):
     """从请求体自动装填被修饰方法的参数，自动类型转换，捕获异常"""
     @functools.wraps(method)
     async def wrapper(self, *args, **kwargs):
+        # 统计本次请求的 token 计数及缓存命中
+        token_stats = token_counter.track_request()
         spec = getfullargspec(method)
         filling_args = spec.args[len(args) + 1:]  # 切出需要填充的参数
         default_values = spec.defaults[-len(filling_args):] if spec.defaults else []  # 切出需要的默认值
@@ -107,6 +111,12 @@ def arguments(method):
         except ParametersError as e:
             logging.warn(e)
             self.finish({'code': -1, 'msg': '参数错误'})
+        except Overloaded as e:
+            # 过载拒绝返回 503/429，客户端按 Retry-After 重试
+            self.set_status(e.status)
+            if e.retry_after is not None:
+                self.set_header('Retry-After', str(math.ceil(e.retry_after)))
+            self.finish({'code': e.code, 'msg': e.msg})
         except (NotFound, Duplicate, PermissionDenied, InternalError) as e:
             self.finish({'code': e.code, 'msg': e.msg})
         except Finish as e:
@@ -117,22 +127,23 @@ def arguments(method):
         finally:
             for key, model in model_dict.items():
                 model.clear()
+            if token_stats.calls:
+                logging.info('%s %s tokens: %s', self.request.method, self.request.path,
+                             token_stats.as_dict())
 
     return wrapper
 
 
-import tiktoken
 import aiofiles
 import hashlib
 from typing import List
+from bisect import bisect_right
+from itertools import accumulate
 import re
 
 
-ENCODER = tiktoken.get_encoding("cl100k_base")
-
-
 def token_str(content: str) -> int:
-    return len(ENCODER.encode(content))
+    return token_counter.count(content)
 
 
 async def get_pdf_md5(pdf_file_path: str) -> str:
@@ -142,41 +153,66 @@ async def get_pdf_md5(pdf_file_path: str) -> str:
     return pdf_md5
 
 
+def token_char_ends(text: str, tokens: List[int]) -> List[int]:
+    """每个 token 结束处对应的字符位置，跨字符的 token 计到已完整覆盖的字符"""
+    char_byte_ends = list(accumulate(len(c.encode('utf-8')) for c in text))
+    token_byte_ends = accumulate(len(ENCODER.decode_single_token_bytes(t)) for t in tokens)
+    return [bisect_right(char_byte_ends, end) for end in token_byte_ends]
+
+
 def chunk_text_by_max_token(text: str, max_token=512) -> List[str]:
-    if token_str(text) <= max_token:
+    """
+    按 max_token 切分文本，切分点优先落在最后一个句末标点之后
+    整段只编码一次，用 token 的字符位置估计切分点，再对单个切片编码校验，总耗时与文本长度线性相关
+    切分点与原来按 400/200/100 字符步长增长前缀的结果一致: 从切片起点起 100 字符的整数倍或文本末尾中，
+    token 数不超过 max_token 的最远位置
+    """
+    tokens = token_counter.encode(text)
+    if len(tokens) <= max_token:
         return [text]
+    ends = token_char_ends(text, tokens)
     res = []
-    num_split = token_str(text) // max_token
     # 切分的步长
-    steps = [400, 200, 100]
+    step = 100
     # 搜索标点符号正则
     punctuation = r'(?<!\d)([。？！…?!]|\.(?=\s))(?!\d)'
-    while len(text) > 0:
-        split_pos = 0
-        while split_pos < len(text):
-            for step in steps:
-                next_step = min(step, len(text) - split_pos)
-                temp_text = text[:split_pos + next_step]
-                if token_str(temp_text) <= max_token:
-                    split_pos += next_step
-                    break
-            else:
-                break
+    start = 0
+    while start < len(text):
+        def fits(pos):
+            return token_counter.count(text[start:pos], cache=False) <= max_token
+
+        def candidate(pos):
+            return len(text) if pos >= len(text) else start + (pos - start) // step * step
+
+        # 用整体编码估计 max_token 个 token 之后的位置
+        first = bisect_right(ends, start)
+        guess = ends[first + max_token - 1] if first + max_token - 1 < len(ends) else len(text)
+        split_pos = candidate(guess)
+        if split_pos > start and fits(split_pos):
+            while split_pos < len(text) and fits(candidate(split_pos + step)):
+                split_pos = candidate(split_pos + step)
+        else:
+            split_pos = candidate(split_pos - 1) if split_pos > start else start
+            while split_pos > start and not fits(split_pos):
+                split_pos = candidate(split_pos - 1)
+        if split_pos <= start:
+            # 100 个字符就超过 max_token，直接按 token 位置切
+            split_pos = max(start + 1, min(guess, len(text)))
         # 搜索最后一个标点符号
-        search_res = re.search(punctuation, text[:split_pos][::-1])
+        search_res = re.search(punctuation, text[start:split_pos][::-1])
         if search_res:
             split_pos = split_pos - int(search_res.end()) + 1
-        res.append(text[:split_pos])
-        text = text[split_pos:]
+        res.append(text[start:split_pos])
+        start = split_pos
     return res
 
 def chunk_list_by_max_token(paragraphs: List[str], max_token=512) -> List[str]:
     res = []
     temp_text = ''
-    for paragraph in paragraphs:
-        if token_str(paragraph) > max_token:
+    for paragraph, paragraph_tokens in zip(paragraphs, token_counter.count_batch(paragraphs)):
+        if paragraph_tokens > max_token:
             res.extend(chunk_text_by_max_token(paragraph, max_token))
-        elif token_str(temp_text + paragraph) > max_token:
+        elif token_counter.count(temp_text + paragraph, cache=False) > max_token:
             res.append(temp_text)
             temp_text = paragraph + '\n'
         else:
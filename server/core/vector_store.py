@@ -0,0 +1,236 @@
+import gc
+import os
+import pickle
+import logging
+import threading
+from collections import OrderedDict
+
+import faiss
+from core.chunk_store import ChunkStore, chunk_files
+from core.index_factory import apply_search_params, search_index
+
+
+# 存向量的文件夹
+INDEX_PATH = os.path.join(os.getcwd(), 'embedding')
+os.makedirs(INDEX_PATH, exist_ok=True)
+
+# 单个进程常驻向量库的内存预算(MB)
+VECTOR_STORE_MEMORY_MB = int(os.getenv('VECTOR_STORE_MEMORY_MB', 2048))
+# 以只读 mmap 方式载入 .index 文件，多进程共享同一份页缓存
+VECTOR_STORE_MMAP = os.getenv('VECTOR_STORE_MMAP', '0') == '1'
+
+# 新版 faiss 的 IO_FLAG_MMAP_IFC 可以直接映射 Flat 索引的向量，旧版只有 IO_FLAG_MMAP
+MMAP_IO_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+def store_prefix(name: str) -> str:
+    return os.path.join(INDEX_PATH, name)
+
+
+def store_files(name: str):
+    """返回小说向量库对应的 (index, 段落表, 切片表, 文本块) 文件路径"""
+    prefix = store_prefix(name)
+    return (f"{prefix}.index", ) + chunk_files(prefix)
+
+
+def convert_legacy_store(name: str) -> bool:
+    """旧版 <name>.pkl 存在而切片库不存在时，转换一次"""
+    prefix = store_prefix(name)
+    pkl_path = f"{prefix}.pkl"
+    if not os.path.exists(pkl_path) or not os.path.exists(f"{prefix}.index"):
+        return False
+    with open(pkl_path, "rb") as f:
+        store = pickle.load(f)
+    ChunkStore.convert_langchain(prefix, store)
+    return True
+
+
+def read_index(index_path: str, mmap: bool = False):
+    if not mmap:
+        return faiss.read_index(index_path)
+    try:
+        return faiss.read_index(index_path, MMAP_IO_FLAGS)
+    except RuntimeError as e:
+        # 部分索引类型不支持 mmap，退回普通载入
+        logging.warning('mmap %s failed, fallback to read: %s', index_path, e)
+        return faiss.read_index(index_path)
+
+
+def mapped_memory(path: str) -> dict:
+    """统计当前进程中映射 path 的常驻内存与共享内存(字节)，来自 /proc/self/smaps"""
+    usage = {'rss': 0, 'shared': 0, 'private': 0}
+    try:
+        with open('/proc/self/smaps', 'r') as f:
+            in_mapping = False
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                if not fields[0].endswith(':'):
+                    # 映射区的首行: 地址 权限 偏移 设备 inode 路径
+                    in_mapping = len(fields) >= 6 and fields[5] == path
+                    continue
+                if not in_mapping:
+                    continue
+                key = fields[0][:-1]
+                if key == 'Rss':
+                    usage['rss'] += int(fields[1]) * 1024
+                elif key.startswith('Shared_'):
+                    usage['shared'] += int(fields[1]) * 1024
+                elif key.startswith('Private_'):
+                    usage['private'] += int(fields[1]) * 1024
+    except OSError:
+        pass
+    return usage
+
+
+def file_signature(paths):
+    """用 mtime 和 size 标识文件版本，文件不存在返回 None"""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class LoadedStore:
+    """已载入内存的向量库: faiss 索引 + 切片库"""
+
+    def __init__(self, name, index, chunks: ChunkStore, signature, nbytes,
+                 index_path='', mmap=False):
+        self.name = name
+        self.index = index
+        self.chunks = chunks
+        self.signature = signature
+        self.nbytes = nbytes
+        self.index_path = index_path
+        self.mmap = mmap
+
+    def search(self, queries, k: int):
+        """返回 (距离, 向量 id)，压缩索引按配置用原始向量精排"""
+        return search_index(self.index, queries, k,
+                            spec=self.chunks.meta.get('index'),
+                            vectors=self.chunks.vectors,
+                            rows=self.chunks.row)
+
+    def memory(self) -> dict:
+        """常驻与共享内存；非 mmap 载入的索引在堆上，无法区分共享页，按估算值计为常驻"""
+        if self.mmap:
+            usage = mapped_memory(os.path.realpath(self.index_path))
+            if usage['rss'] or usage['shared']:
+                return dict(usage, mmap=True)
+        return {'rss': self.nbytes, 'shared': 0, 'private': self.nbytes, 'mmap': False}
+
+
+class VectorStoreRegistry:
+    """
+    进程内的向量库缓存，按小说名索引
+    - 每个向量库只载入一次，文件 mtime/size 变化后重新载入
+    - 超出内存预算时淘汰最久未使用的向量库
+    """
+
+    def __init__(self,
+                 memory_budget: int = VECTOR_STORE_MEMORY_MB * 1024 * 1024,
+                 mmap: bool = VECTOR_STORE_MMAP):
+        self.memory_budget = memory_budget
+        self.mmap = mmap
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name: str) -> LoadedStore:
+        paths = store_files(name)
+        signature = file_signature(paths)
+        with self._lock:
+            loaded = self._stores.get(name)
+            if loaded and loaded.signature == signature:
+                self._stores.move_to_end(name)
+                self.hits += 1
+                return loaded
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # 同一本小说只允许一个线程载入，其他线程等待后复用结果
+        with load_lock:
+            if signature is None:
+                if not convert_legacy_store(name):
+                    raise Exception("索引文件不存在")
+                signature = file_signature(paths)
+            with self._lock:
+                loaded = self._stores.get(name)
+                if loaded and loaded.signature == signature:
+                    self._stores.move_to_end(name)
+                    self.hits += 1
+                    return loaded
+                self.misses += 1
+            loaded = self._load(name, paths, signature)
+            with self._lock:
+                self._stores[name] = loaded
+                self._stores.move_to_end(name)
+                self._evict(keep=name)
+        return loaded
+
+    def _load(self, name, paths, signature) -> LoadedStore:
+        index_path = paths[0]
+        logging.info('load vector store %s', name)
+        index = read_index(index_path, mmap=self.mmap)
+        chunks = ChunkStore.open(store_prefix(name))
+        apply_search_params(index, chunks.meta.get('index'))
+        # 以文件大小估算常驻内存；原始向量文件只在精排时按行读取，不计入
+        nbytes = sum(size for _, size in signature)
+        return LoadedStore(name, index, chunks, signature, nbytes, index_path, self.mmap)
+
+    def preload(self, names):
+        """
+        在 fork 之前由父进程调用，预先载入向量库，
+        子进程以写时复制的方式共享这些内存页
+        """
+        for name in names:
+            self.get(name)
+        # 冻结已有对象，避免子进程中 gc 修改引用计数导致共享页被复制
+        gc.freeze()
+
+    def _evict(self, keep: str):
+        while self.memory_usage() > self.memory_budget and len(self._stores) > 1:
+            name, _ = next(iter(self._stores.items()))
+            if name == keep:
+                break
+            self._stores.popitem(last=False)
+            self.evictions += 1
+            logging.info('evict vector store %s', name)
+
+    def invalidate(self, name: str = None):
+        with self._lock:
+            if name is None:
+                self._stores.clear()
+            else:
+                self._stores.pop(name, None)
+
+    def memory_usage(self) -> int:
+        return sum(loaded.nbytes for loaded in self._stores.values())
+
+    def memory_report(self) -> dict:
+        """每个已载入索引的常驻/共享内存"""
+        with self._lock:
+            loaded_stores = list(self._stores.values())
+        return {loaded.name: loaded.memory() for loaded in loaded_stores}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'stores': list(self._stores.keys()),
+                'mmap': self.mmap,
+                'memory_usage': self.memory_usage(),
+                'memory_budget': self.memory_budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+vector_stores = VectorStoreRegistry()
@@ -3,6 +3,7 @@ root_path = os.path.abspath(__file__)
 sys.path.append(root_path)
 
 import logging
+import asyncio
 import json
 
 import tornado.log
@@ -10,6 +11,8 @@ import tornado.web
 import tornado.ioloop
 import tornado.autoreload
 import tornado.httpserver
+import tornado.websocket
+from tornado.iostream import StreamClosedError
 from tornado.options import options, parse_command_line
 from core.route import routes, route
 from core.utils import *
@@ -18,12 +21,32 @@ from core.utils import *
 from dotenv import load_dotenv
 import os,sys
 from model import ServerModel
+from core.vector_store import vector_stores
+from core.base import HandlerContext
+from core.sse import format_event
+from core.chat import openai, query_embedding, retrieval
+from core.admission import chat_admission
+from core.persona import personas
 # 读取 .env file.
 load_dotenv()
 api_keys = os.getenv('API_KEYS')
 print(api_keys)
 HOST = os.getenv('HOST')
 PORT = os.getenv('PORT')
+# 进程数，0 表示按 CPU 核数 fork
+PROCESSES = int(os.getenv('PROCESSES', 1))
+# fork 之前预先载入的小说向量库，逗号分隔
+PRELOAD_NOVELS = [name for name in os.getenv('PRELOAD_NOVELS', '').split(',') if name]
+# 每个 WebSocket 连接上同时进行的对话数上限
+WS_MAX_CONVERSATIONS = int(os.getenv('WS_MAX_CONVERSATIONS', 8))
+# WebSocket 心跳间隔秒数，及时发现断开的移动端连接
+WS_PING_INTERVAL = float(os.getenv('WS_PING_INTERVAL', 30))
+# 各聊天接口的回复 token 上限，字符数上限见 model.ANSWER_MAX_CHARS
+CHAT_LIMITS = {
+    'chat': {'max_tokens': int(os.getenv('CHAT_MAX_TOKENS', 512))},
+    'chat_stream': {'max_tokens': int(os.getenv('CHAT_STREAM_MAX_TOKENS', 512))},
+    'chat_ws': {'max_tokens': int(os.getenv('CHAT_WS_MAX_TOKENS', 512))},
+}
 
 
         
@@ -107,7 +130,7 @@ class ChatHandler(tornado.web.RequestHandler):
         character_id: str = "",
         model: ServerModel = None
     ):
-        answer = await model.chat(query,character_id)
+        answer = await model.chat(query,character_id, **CHAT_LIMITS['chat'])
         self.finish({
             "code": 0,
             "msg": "success",
@@ -116,6 +139,127 @@ class ChatHandler(tornado.web.RequestHandler):
             }]
         })
 
+@route(r"/novel/character/chat/stream")
+class ChatStreamHandler(tornado.web.RequestHandler):
+    _json_args = {}
+    def prepare(self):
+        try:
+            body = self.request.body.decode('utf8')
+            self._json_args = body and json.loads(body) or {}
+        except Exception as e:
+            logging.error(e)
+    # post /novel/character/chat/stream
+    # 以 Server-Sent Events 逐段返回 data: {"content": "..."}，出错时为 event: error，结束时为 data: [DONE]
+    @arguments
+    async def post(
+        self,
+        query: str = "",
+        character_id: str = "",
+        model: ServerModel = None
+    ):
+        self.set_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.set_header('Cache-Control', 'no-cache')
+        # 关闭 nginx 等反向代理的响应缓冲
+        self.set_header('X-Accel-Buffering', 'no')
+        stream = model.chat_stream(query, character_id, **CHAT_LIMITS['chat_stream'])
+        try:
+            async for delta in stream:
+                self.write(format_event({"content": delta}))
+                # 等数据写入 socket 后再继续读上游，慢客户端会反压到上游
+                await self.flush()
+        except StreamClosedError:
+            # 客户端已断开，停止生成
+            return
+        except Overloaded:
+            # 准入被拒时还没有任何输出，去掉 SSE 响应头，由 arguments 返回 JSON 的 503 和 Retry-After
+            for name in ('Content-Type', 'Cache-Control', 'X-Accel-Buffering'):
+                self.clear_header(name)
+            raise
+        except InternalError as e:
+            self.write(format_event({"code": e.code, "msg": e.msg}, event='error'))
+        except Exception as e:
+            logging.exception(e)
+            self.write(format_event({"code": -1, "msg": "内部错误"}, event='error'))
+        finally:
+            await stream.aclose()
+        self.finish("data: [DONE]\n\n")
+
+@route(r"/novel/character/chat/ws")
+class ChatWebSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+    WebSocket 聊天，一个连接上可以同时进行多个对话，按 convo_id 区分
+    客户端发送:
+        {"type": "chat", "convo_id": "...", "character_id": "...", "query": "..."}
+        {"type": "cancel", "convo_id": "..."}
+    服务端返回:
+        {"type": "delta", "convo_id": "...", "content": "..."}
+        {"type": "done", "convo_id": "..."}
+        {"type": "cancelled", "convo_id": "..."}
+        {"type": "error", "convo_id": "...", "code": -1, "msg": "..."}
+    服务过载被拒绝时 error 中带有 retry_after 秒数
+    """
+
+    def open(self):
+        self.tasks = {}
+
+    def on_close(self):
+        # 连接断开，停止所有进行中的生成
+        for task in self.tasks.values():
+            task.cancel()
+
+    async def send(self, **message):
+        await self.write_message(json.dumps(message, ensure_ascii=False))
+
+    async def on_message(self, message):
+        try:
+            message = json.loads(message)
+            kind, convo_id = message['type'], str(message['convo_id'])
+        except Exception:
+            await self.send(type="error", convo_id=None, code=-1, msg="参数错误")
+            return
+        if kind == 'cancel':
+            task = self.tasks.get(convo_id)
+            if task:
+                task.cancel()
+        elif kind == 'chat':
+            if convo_id in self.tasks:
+                await self.send(type="error", convo_id=convo_id, code=-1, msg="对话正在进行中")
+            elif len(self.tasks) >= WS_MAX_CONVERSATIONS:
+                await self.send(type="error", convo_id=convo_id, code=-1, msg="同时进行的对话过多")
+            else:
+                task = asyncio.ensure_future(self.chat(
+                    convo_id, str(message.get('query', '')), str(message.get('character_id', ''))))
+                self.tasks[convo_id] = task
+                task.add_done_callback(lambda _: self.tasks.pop(convo_id, None))
+        else:
+            await self.send(type="error", convo_id=convo_id, code=-1, msg="参数错误")
+
+    async def chat(self, convo_id: str, query: str, character_id: str):
+        with ServerModel(context=HandlerContext(self)) as model:
+            stream = model.chat_stream(query, character_id, **CHAT_LIMITS['chat_ws'])
+            try:
+                async for delta in stream:
+                    # 等待帧写出，慢客户端会反压到上游
+                    await self.send(type="delta", convo_id=convo_id, content=delta)
+                await self.send(type="done", convo_id=convo_id)
+            except asyncio.CancelledError:
+                if self.ws_connection:
+                    await self.send(type="cancelled", convo_id=convo_id)
+            except tornado.websocket.WebSocketClosedError:
+                pass
+            except Overloaded as e:
+                await self.send(type="error", convo_id=convo_id, code=e.code, msg=e.msg,
+                                retry_after=e.retry_after)
+            except InternalError as e:
+                await self.send(type="error", convo_id=convo_id, code=e.code, msg=e.msg)
+            except Exception as e:
+                logging.exception(e)
+                await self.send(type="error", convo_id=convo_id, code=-1, msg="内部错误")
+            finally:
+                # 取消可能发生在生成器暂停于 yield 时，显式关闭以立即归还准入名额、key 和上游连接
+                await stream.aclose()
+
+
 @route(r"/novel/character/([0-9a-z]+)")
 class ChatHandler(tornado.web.RequestHandler):
     _json_args = {}
@@ -152,17 +296,45 @@ class ChatHandler(tornado.web.RequestHandler):
         })
 
 
-
+@route(r"/stats")
+class StatsHandler(tornado.web.RequestHandler):
+    """当前 worker 进程的运行指标，只读；多进程时每次请求落到其中一个 worker"""
+    # get /stats
+    def get(self):
+        chat_api = openai.openAIAPI
+        self.finish({
+            "code": 0,
+            "msg": "success",
+            "data": {
+                "pid": os.getpid(),
+                "admission": chat_admission.stats(),
+                "http": chat_api.http.stats.as_dict(),
+                "resilience": chat_api.resilience.stats(),
+                "keys": chat_api.keys.stats(),
+                "models": chat_api.router.stats(),
+                "conversations": chat_api.conversation.stats(),
+                "tokens": token_counter.stats(),
+                "personas": personas.stats(),
+                "query_embedding": query_embedding.stats(),
+                "retrieval": retrieval.stats(),
+                "vector_stores": vector_stores.stats(),
+                "vector_store_memory": vector_stores.memory_report(),
+            }
+        })
 
 
 if __name__ == "__main__":
 
     application = tornado.web.Application(routes(), **dict(
-        debug=True,
+        # autoreload 不支持多进程
+        debug=PROCESSES == 1,
+        websocket_ping_interval=WS_PING_INTERVAL,
     ))
+    # 父进程先载入索引，fork 出的子进程共享这部分内存
+    vector_stores.preload(PRELOAD_NOVELS)
     server = tornado.httpserver.HTTPServer(application)
-    server.listen(port=PORT)
-    server.start()
+    server.bind(port=PORT)
+    server.start(PROCESSES)
     logging.info("Start Success: 0.0.0.0:{}".format(PORT))
 
     tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,267 @@
+"""
+本地模拟的 OpenAI 接口，用于压测和 CI，不请求真实接口、不消耗额度
+支持 chat/completions(流式与非流式)和 embeddings，相同请求返回相同结果
+
+    python server/mock_openai.py --port 8900 --ttft 0.5 --tokens-per-second 40
+    python server/mock_openai.py --error-rate 0.02 --rate-limit-rate 0.05 --key-rpm 600
+
+    # 服务指向 mock
+    OPENAI_API_BASE=http://127.0.0.1:8900/v1 python server/handler.py
+
+GET /stats 返回请求数、注入的错误数等计数
+"""
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+from collections import defaultdict, deque
+
+import numpy as np
+import tornado.web
+import tornado.ioloop
+from tornado.iostream import StreamClosedError
+
+from core.token_budget import Conversation
+
+
+# 回复从这段文本中按请求内容确定起点循环截取，每个字符算一个 token
+CORPUS = ("这里是本地模拟的回复内容，相同的请求总是得到相同的回复。"
+          "The mock server streams one token per chunk at a configurable rate. ")
+
+
+class MockProfile:
+    """延迟和错误注入参数"""
+
+    def __init__(self, args):
+        self.ttft = args.ttft
+        self.ttft_jitter = args.ttft_jitter
+        self.tokens_per_second = args.tokens_per_second
+        self.completion_tokens = args.completion_tokens
+        self.error_rate = args.error_rate
+        self.abort_rate = args.abort_rate
+        self.rate_limit_rate = args.rate_limit_rate
+        self.key_rpm = args.key_rpm
+        self.retry_after = args.retry_after
+        self.embedding_dim = args.embedding_dim
+        self.embedding_latency = args.embedding_latency
+        self.random = random.Random(args.seed)
+        self.requests = defaultdict(deque)
+        self.counters = defaultdict(int)
+
+    def first_token_delay(self) -> float:
+        return max(0.0, self.ttft + self.random.uniform(-self.ttft_jitter, self.ttft_jitter))
+
+    def token_interval(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def rate_limited(self, key: str) -> bool:
+        """按概率注入 429，或者该 key 最近一分钟的请求数超过 key_rpm"""
+        if self.random.random() < self.rate_limit_rate:
+            return True
+        if self.key_rpm <= 0:
+            return False
+        now = time.monotonic()
+        window = self.requests[key]
+        while window and window[0] <= now - 60:
+            window.popleft()
+        if len(window) >= self.key_rpm:
+            return True
+        window.append(now)
+        return False
+
+
+def digest(data) -> int:
+    raw = json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'little')
+
+
+def completion_text(messages: list, max_tokens: int, stop) -> (list, str):
+    """按消息内容确定的回复，返回 (逐 token 的片段, finish_reason)"""
+    start = digest(messages) % len(CORPUS)
+    pieces = [CORPUS[(start + i) % len(CORPUS)] for i in range(max_tokens)]
+    if isinstance(stop, str):
+        stop = [stop]
+    text = ''.join(pieces)
+    cut = min([text.find(s) for s in stop or [] if s and s in text], default=-1)
+    if cut >= 0:
+        return pieces[:cut], 'stop'
+    return pieces, 'length'
+
+
+def embedding_vector(text, dim: int) -> list:
+    """按输入确定的单位向量，输入可以是字符串或 token 列表"""
+    rng = np.random.default_rng(digest(text))
+    vector = rng.normal(size=dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class MockHandler(tornado.web.RequestHandler):
+
+    def initialize(self, profile: MockProfile):
+        self.profile = profile
+
+    def error(self, status: int, message: str, kind: str):
+        self.profile.counters[f'status_{status}'] += 1
+        self.set_status(status)
+        if status == 429:
+            self.set_header('Retry-After', str(self.profile.retry_after))
+        self.finish({'error': {'message': message, 'type': kind}})
+
+    def api_key(self):
+        auth = self.request.headers.get('Authorization', '')
+        return auth[len('Bearer '):] if auth.startswith('Bearer ') else ''
+
+    def check_request(self) -> bool:
+        """鉴权及错误注入，返回是否继续处理"""
+        self.profile.counters['requests'] += 1
+        key = self.api_key()
+        if not key:
+            self.error(401, 'Missing API key', 'invalid_request_error')
+            return False
+        if self.profile.rate_limited(key):
+            self.error(429, 'Rate limit reached', 'requests')
+            return False
+        if self.profile.random.random() < self.profile.error_rate:
+            self.error(500, 'Injected server error', 'server_error')
+            return False
+        return True
+
+
+class ChatCompletionsHandler(MockHandler):
+
+    async def post(self):
+        if not self.check_request():
+            return
+        body = json.loads(self.request.body)
+        messages = body.get('messages', [])
+        model = body.get('model', 'gpt-3.5-turbo')
+        max_tokens = body.get('max_tokens') or self.profile.completion_tokens
+        pieces, finish_reason = completion_text(messages, max_tokens, body.get('stop'))
+        usage = {
+            'prompt_tokens': Conversation(messages).prompt_tokens(),
+            'completion_tokens': len(pieces),
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        completion_id = f"chatcmpl-{digest(messages):x}"
+
+        await asyncio.sleep(self.profile.first_token_delay())
+        if not body.get('stream'):
+            await asyncio.sleep(self.profile.token_interval() * len(pieces))
+            self.finish({
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ''.join(pieces)},
+                    'finish_reason': finish_reason,
+                }],
+                'usage': usage,
+            })
+            return
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        abort_at = 1 + self.profile.random.randrange(len(pieces)) \
+            if pieces and self.profile.random.random() < self.profile.abort_rate else None
+
+        def chunk(delta, finish=None):
+            return {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}],
+            }
+
+        events = [chunk({'role': 'assistant', 'content': ''})]
+        events += [chunk({'content': piece}) for piece in pieces]
+        events.append(chunk({}, finish_reason))
+        if (body.get('stream_options') or {}).get('include_usage'):
+            events.append({'id': completion_id, 'object': 'chat.completion.chunk',
+                           'model': model, 'choices': [], 'usage': usage})
+        try:
+            for i, event in enumerate(events):
+                if i == abort_at:
+                    # 模拟输出中途断开
+                    self.profile.counters['aborted'] += 1
+                    self.request.connection.close()
+                    return
+                self.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+                await self.flush()
+                if 0 < i < len(pieces):
+                    await asyncio.sleep(self.profile.token_interval())
+            self.finish("data: [DONE]\n\n")
+        except StreamClosedError:
+            self.profile.counters['client_disconnected'] += 1
+
+
+class EmbeddingsHandler(MockHandler):
+
+    async def post(self):
+        if not self.check_request():
+            return
+        body = json.loads(self.request.body)
+        inputs = body.get('input', [])
+        # 单条输入可能是字符串或一个 token 列表
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        await asyncio.sleep(self.profile.embedding_latency)
+        tokens = sum(len(item) for item in inputs)
+        self.finish({
+            'object': 'list',
+            'data': [{
+                'object': 'embedding',
+                'index': i,
+                'embedding': embedding_vector(item, self.profile.embedding_dim),
+            } for i, item in enumerate(inputs)],
+            'model': body.get('model', 'text-embedding-ada-002'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+
+class StatsHandler(MockHandler):
+
+    def get(self):
+        self.finish(dict(self.profile.counters))
+
+
+def make_app(profile: MockProfile) -> tornado.web.Application:
+    return tornado.web.Application([
+        (r"/v1/chat/completions", ChatCompletionsHandler, dict(profile=profile)),
+        (r"/v1/embeddings", EmbeddingsHandler, dict(profile=profile)),
+        (r"/stats", StatsHandler, dict(profile=profile)),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI 接口的本地模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--ttft', type=float, default=0.5, help='首 token 延迟秒数')
+    parser.add_argument('--ttft-jitter', type=float, default=0.1, help='首 token 延迟的随机波动秒数')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='0 表示不限速')
+    parser.add_argument('--completion-tokens', type=int, default=200,
+                        help='请求没有 max_tokens 时的回复 token 数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例')
+    parser.add_argument('--abort-rate', type=float, default=0.0, help='流式输出中途断开的比例')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='随机返回 429 的比例')
+    parser.add_argument('--key-rpm', type=int, default=0, help='每个 key 每分钟的请求数上限，0 表示不限')
+    parser.add_argument('--retry-after', type=float, default=1, help='429 的 Retry-After 秒数')
+    parser.add_argument('--embedding-dim', type=int, default=1536)
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0, help='错误注入的随机种子')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    make_app(MockProfile(args)).listen(args.port, args.host)
+    logging.info('mock OpenAI API on http://%s:%d/v1', args.host, args.port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,18 @@ from sqlalchemy import func, sql
 from core.base import MysqlModel
 from core.schema import *
 from core.chat import *
+from core.admission import chat_admission
+from contextlib import nullcontext
+
+
+# 回复的字符数上限，与 ChatLog.answer 的长度一致，保证完整存入和展示
+ANSWER_MAX_CHARS = ChatLog.__table__.c.answer.type.length
+
+
+def answer_limits(limits: dict) -> dict:
+    """接口传入的回复上限，字符数不超过 ANSWER_MAX_CHARS"""
+    max_chars = limits.get('max_chars') or ANSWER_MAX_CHARS
+    return {**limits, 'max_chars': min(max_chars, ANSWER_MAX_CHARS)}
 
 
 class ServerModel(MysqlModel):
@@ -61,15 +73,30 @@ class ServerModel(MysqlModel):
         # return row2dict(character),[row2dict(item) for item in self.query_all(chatlogs)], total
         return [row2dict(item) for item in character.all()], [row2dict(item) for item in chatlogs.all()], total
 
-    async def chat(self, query, character_id):
-        import asyncio
-
-        openai.openAIAPI.lock = asyncio.Lock()
-        openAI_semaphore = asyncio.Semaphore(50)
-        answer = await chat_book(openAI_semaphore, 'novels/santi.json', 'novels/ye.txt', 'santi', 'ye', query)
+    async def chat(self, query, character_id, **limits):
+        """limits 为回复上限(max_tokens/stop/max_chars)，见 OpenAI.generate_answer_by_search_results"""
+        # 进程内共用的准入控制，在检索之前准入，超过并发和排队上限时立即抛出 Overloaded
+        async with chat_admission:
+            answer = await chat_book(nullcontext(), 'novels/santi.json', 'novels/ye.txt', 'santi', 'ye', query,
+                                     **answer_limits(limits))
         # answer = await chat_book(openAI_semaphore, 'santi.json', 'ye.txt', 'santi', 'ye', query)
+        await self.save_chat_log(query, character_id, answer)
+        return answer
+
+    async def chat_stream(self, query, character_id, **limits):
+        """逐段返回回复，完整回复在结束后写入聊天记录"""
+        deltas = []
+        async with chat_admission:
+            async for delta in chat_book_stream(nullcontext(), 'novels/santi.json', 'novels/ye.txt', 'santi', 'ye', query,
+                                                **answer_limits(limits)):
+                deltas.append(delta)
+                yield delta
+        await self.save_chat_log(query, character_id, ''.join(deltas))
+
+    async def save_chat_log(self, query, character_id, answer):
         import random
         rate = random.randint(1, 100000000)
 
-        await self.try_insert_record(ChatLog, "id", people_id=character_id, id=rate, query=query, answer=answer)
-        return answer
+        # 超长的部分截掉，避免写入失败(严格模式)或被数据库静默截断
+        await self.try_insert_record(ChatLog, "id", people_id=character_id, id=rate,
+                                     query=query, answer=(answer or '')[:ANSWER_MAX_CHARS])
@@ -2,6 +2,8 @@ import tiktoken
 import aiofiles
 import hashlib
 from typing import List
+from bisect import bisect_right
+from itertools import accumulate
 import re
 
 ENCODER = tiktoken.get_encoding("cl100k_base")
@@ -18,32 +20,57 @@ async def get_pdf_md5(pdf_file_path: str) -> str:
     return pdf_md5
 
 
+def token_char_ends(text: str, tokens: List[int]) -> List[int]:
+    """每个 token 结束处对应的字符位置，跨字符的 token 计到已完整覆盖的字符"""
+    char_byte_ends = list(accumulate(len(c.encode('utf-8')) for c in text))
+    token_byte_ends = accumulate(len(ENCODER.decode_single_token_bytes(t)) for t in tokens)
+    return [bisect_right(char_byte_ends, end) for end in token_byte_ends]
+
+
 def chunk_text_by_max_token(text: str, max_token=512) -> List[str]:
-    if token_str(text) <= max_token:
+    """
+    按 max_token 切分文本，切分点优先落在最后一个句末标点之后
+    整段只编码一次，用 token 的字符位置估计切分点，再对单个切片编码校验，总耗时与文本长度线性相关
+    切分点与原来按 400/200/100 字符步长增长前缀的结果一致: 从切片起点起 100 字符的整数倍或文本末尾中，
+    token 数不超过 max_token 的最远位置
+    """
+    tokens = ENCODER.encode(text)
+    if len(tokens) <= max_token:
         return [text]
+    ends = token_char_ends(text, tokens)
     res = []
-    num_split = token_str(text) // max_token
     # 切分的步长
-    steps = [400, 200, 100]
+    step = 100
     # 搜索标点符号正则
     punctuation = r'(?<!\d)([。？！…?!]|\.(?=\s))(?!\d)'
-    while len(text) > 0:
-        split_pos = 0
-        while split_pos < len(text):
-            for step in steps:
-                next_step = min(step, len(text) - split_pos)
-                temp_text = text[:split_pos + next_step]
-                if token_str(temp_text) <= max_token:
-                    split_pos += next_step
-                    break
-            else:
-                break
+    start = 0
+    while start < len(text):
+        def fits(pos):
+            return token_str(text[start:pos]) <= max_token
+
+        def candidate(pos):
+            return len(text) if pos >= len(text) else start + (pos - start) // step * step
+
+        # 用整体编码估计 max_token 个 token 之后的位置
+        first = bisect_right(ends, start)
+        guess = ends[first + max_token - 1] if first + max_token - 1 < len(ends) else len(text)
+        split_pos = candidate(guess)
+        if split_pos > start and fits(split_pos):
+            while split_pos < len(text) and fits(candidate(split_pos + step)):
+                split_pos = candidate(split_pos + step)
+        else:
+            split_pos = candidate(split_pos - 1) if split_pos > start else start
+            while split_pos > start and not fits(split_pos):
+                split_pos = candidate(split_pos - 1)
+        if split_pos <= start:
+            # 100 个字符就超过 max_token，直接按 token 位置切
+            split_pos = max(start + 1, min(guess, len(text)))
         # 搜索最后一个标点符号
-        search_res = re.search(punctuation, text[:split_pos][::-1])
+        search_res = re.search(punctuation, text[start:split_pos][::-1])
         if search_res:
             split_pos = split_pos - int(search_res.end()) + 1
-        res.append(text[:split_pos])
-        text = text[split_pos:]
+        res.append(text[start:split_pos])
+        start = split_pos
     return res
 
 def chunk_list_by_max_token(paragraphs: List[str], max_token=512) -> List[str]: